@@ -0,0 +1,81 @@
+"""Standalone bot worker that builds servers from the Mongo job queue.
+
+Run one process per shard next to the API started with SERVER_CREATION_QUEUE=mongo:
+
+    python bot_worker.py --shard-id 0 --shard-count 2 --concurrency 4
+
+Any worker may claim any job: a new guild's shard isn't known until it
+exists. Builds of guilds on another shard go on over REST without waiting
+for their GUILD_CREATE.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import signal
+
+async def run_worker(worker_id: str, concurrency: int):
+    import server
+    from server import bot, bot_ready_event, flush_logs, invites, job_queue, logger, record_discord_rate_limit, server_creation_dispatcher, DISCORD_SIMULATOR, SHUTDOWN_DRAIN_TIMEOUT
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stopping.set)
+
+    server_creation_dispatcher.start()
+    if DISCORD_SIMULATOR:
+        from discord_simulator import DiscordSimulator, run_simulated_bot
+        simulator = DiscordSimulator.from_env(on_rate_limit=record_discord_rate_limit)
+        bot_task = asyncio.create_task(run_simulated_bot(bot, simulator))
+    else:
+        bot_task = asyncio.create_task(bot.start(os.environ['DISCORD_BOT_TOKEN']))
+
+    try:
+        await server.ensure_indexes()
+    except Exception as e:
+        logger.error(f"Error creating MongoDB indexes: {e}")
+
+    # Only claim jobs once the bot has logged in
+    ready = asyncio.create_task(bot_ready_event.wait())
+    stop = asyncio.create_task(stopping.wait())
+    await asyncio.wait({ready, stop, bot_task}, return_when=asyncio.FIRST_COMPLETED)
+    ready.cancel()
+    stop.cancel()
+    if bot_task.done():
+        bot_task.result()
+        return
+
+    logger.info(f"Bot worker {worker_id} started (shard {bot.shard_id}/{bot.shard_count})")
+    await job_queue.run_worker(worker_id, concurrency, stopping)
+
+    await server_creation_dispatcher.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await invites.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await flush_logs()
+    logger.info(f"Bot worker {worker_id} drained, shutting down")
+    await bot.close()
+    with contextlib.suppress(Exception):
+        await bot_task
+    server.client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build Discord servers from the Mongo job queue")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--shard-id", type=int, default=None)
+    parser.add_argument("--shard-count", type=int, default=None)
+    args = parser.parse_args()
+
+    # The bot is built when server is imported, so its shard has to be in the environment first
+    if args.shard_count is not None:
+        os.environ['DISCORD_SHARD_ID'] = str(args.shard_id or 0)
+        os.environ['DISCORD_SHARD_COUNT'] = str(args.shard_count)
+
+    import server
+    args.worker_id = args.worker_id or server.default_worker_id()
+    args.concurrency = args.concurrency or server.SERVER_CREATION_CONCURRENCY
+    asyncio.run(run_worker(args.worker_id, args.concurrency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""Offline stand-in for Discord's REST API and gateway
+
+The simulator replaces ``bot.http.request`` so every REST call made through
+discord.py is answered locally with configurable latency, per-route bucket
+limits, random 429 responses and random 5xx failures. Gateway events for created guilds, roles and
+channels are fed back into the bot's connection state, so the guild cache
+behaves as it would against the real gateway. Used to run builds and
+benchmarks without a bot token.
+"""
+import asyncio
+import itertools
+import os
+import random
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import discord
+
+CHANNEL_TEXT = 0
+CHANNEL_VOICE = 2
+CHANNEL_CATEGORY = 4
+
+
+class SimulatedRateLimit(Exception):
+    def __init__(self, retry_after: float, is_global: bool = False):
+        super().__init__(f"Rate limited for {retry_after:.2f}s")
+        self.retry_after = retry_after
+        self.is_global = is_global
+
+
+class SimulatedBucket:
+    """Fixed window bucket with the same shape as Discord's route buckets"""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.remaining = limit
+        self.reset_at = time.monotonic() + period
+
+    def take(self) -> Optional[float]:
+        """Consume a request, returning the retry delay if the bucket is empty"""
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.period
+        if self.remaining <= 0:
+            return self.reset_at - now
+        self.remaining -= 1
+        return None
+
+
+class DiscordSimulator:
+    """Answers discord.py REST calls in-process and emits matching gateway events"""
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        gateway_delay: float = 0.01,
+        rate_limit_probability: float = 0.0,
+        server_error_probability: float = 0.0,
+        bucket_limit: int = 5,
+        bucket_period: float = 1.0,
+        global_limit: int = 50,
+        on_rate_limit: Optional[Callable[[str, float], None]] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.gateway_delay = gateway_delay
+        self.rate_limit_probability = rate_limit_probability
+        self.server_error_probability = server_error_probability
+        self.bucket_limit = bucket_limit
+        self.bucket_period = bucket_period
+        self.global_bucket = SimulatedBucket(global_limit, 1.0)
+        self.buckets: Dict[Tuple[str, str, Any], SimulatedBucket] = {}
+        self.on_rate_limit = on_rate_limit
+
+        self.bot = None
+        self.guilds: Dict[int, Dict[str, Any]] = {}
+        self.channels: Dict[int, Dict[str, Any]] = {}
+        self._ids = itertools.count(int(time.time() * 1000) << 22)
+        self.calls: Dict[str, int] = {}
+        self.rate_limited = 0
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "DiscordSimulator":
+        """Build a simulator from DISCORD_SIMULATOR_* environment variables"""
+        return cls(
+            latency=float(os.environ.get('DISCORD_SIMULATOR_LATENCY', '0.05')),
+            jitter=float(os.environ.get('DISCORD_SIMULATOR_JITTER', '0.02')),
+            rate_limit_probability=float(os.environ.get('DISCORD_SIMULATOR_429_RATE', '0')),
+            server_error_probability=float(os.environ.get('DISCORD_SIMULATOR_5XX_RATE', '0')),
+            bucket_limit=int(os.environ.get('DISCORD_SIMULATOR_BUCKET_LIMIT', '5')),
+            bucket_period=float(os.environ.get('DISCORD_SIMULATOR_BUCKET_PERIOD', '1')),
+            global_limit=int(os.environ.get('DISCORD_SIMULATOR_GLOBAL_LIMIT', '50')),
+            **kwargs,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "total_calls": sum(self.calls.values()),
+            "rate_limited": self.rate_limited,
+            "guilds": len(self.guilds),
+        }
+
+    async def install(self, bot: discord.Client):
+        """Attach to a bot that will never log in and mark it as connected"""
+        await bot._async_setup_hook()
+        self.bot = bot
+        state = bot._connection
+        user_id = next(self._ids)
+        state.user = discord.ClientUser(state=state, data={
+            "id": str(user_id),
+            "username": "simulated-bot",
+            "discriminator": "0000",
+            "avatar": None,
+            "bot": True,
+        })
+        bot.http.request = self.request
+
+    # REST layer
+    async def request(self, route: discord.http.Route, **kwargs: Any) -> Any:
+        """Drop-in replacement for discord.HTTPClient.request"""
+        handler, params = self._resolve(route)
+        key = f"{route.method} {route.path}"
+        bucket_key = (route.method, route.path, route.guild_id or route.channel_id)
+
+        while True:
+            try:
+                self._check_limits(bucket_key)
+                break
+            except SimulatedRateLimit as limited:
+                # discord.py sleeps on Retry-After and retries, so do the same
+                self.rate_limited += 1
+                if self.on_rate_limit:
+                    self.on_rate_limit("global" if limited.is_global else "user", limited.retry_after)
+                await asyncio.sleep(limited.retry_after)
+
+        self.calls[key] = self.calls.get(key, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.server_error_probability:
+            # discord.py doesn't retry a 503; half of them lose the response of a request that went through
+            if random.random() < 0.5:
+                handler(params, kwargs.get('json') or {})
+            raise discord.DiscordServerError(_FakeResponse(503), "Simulated server error")
+        return handler(params, kwargs.get('json') or {})
+
+    def _check_limits(self, bucket_key: Tuple[str, str, Any]):
+        if self.rate_limit_probability and random.random() < self.rate_limit_probability:
+            raise SimulatedRateLimit(self.bucket_period / max(self.bucket_limit, 1))
+
+        retry_after = self.global_bucket.take()
+        if retry_after is not None:
+            raise SimulatedRateLimit(retry_after, is_global=True)
+
+        if bucket_key not in self.buckets:
+            self.buckets[bucket_key] = SimulatedBucket(self.bucket_limit, self.bucket_period)
+        retry_after = self.buckets[bucket_key].take()
+        if retry_after is not None:
+            raise SimulatedRateLimit(retry_after)
+
+    def _resolve(self, route: discord.http.Route):
+        for method, pattern, handler in self._routes():
+            if method != route.method:
+                continue
+            match = re.fullmatch(pattern, route.path)
+            if not match:
+                continue
+            # Pull the path parameters back out of the formatted URL
+            url_pattern = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(route.path))
+            url_match = re.fullmatch(re.escape(discord.http.Route.BASE) + url_pattern, route.url)
+            params = {name: int(value) for name, value in (url_match.groupdict() if url_match else {}).items()}
+            return handler, params
+        raise discord.NotFound(_FakeResponse(404), {"message": f"Unknown route {route.method} {route.path}", "code": 0})
+
+    def _routes(self) -> List[Tuple[str, str, Callable]]:
+        return [
+            ("POST", r"/guilds", self._create_guild),
+            ("GET", r"/guilds/\{guild_id\}", self._get_guild),
+            ("GET", r"/guilds/\{guild_id\}/channels", self._get_channels),
+            ("POST", r"/guilds/\{guild_id\}/channels", self._create_channel),
+            ("PATCH", r"/guilds/\{guild_id\}/channels", self._move_channels),
+            ("GET", r"/guilds/\{guild_id\}/roles", self._get_roles),
+            ("POST", r"/guilds/\{guild_id\}/roles", self._create_role),
+            ("PATCH", r"/guilds/\{guild_id\}/roles", self._move_roles),
+            ("PATCH", r"/guilds/\{guild_id\}/roles/\{role_id\}", self._edit_role),
+            ("DELETE", r"/guilds/\{guild_id\}/roles/\{role_id\}", self._delete_role),
+            ("PATCH", r"/channels/\{channel_id\}", self._edit_channel),
+            ("DELETE", r"/channels/\{channel_id\}", self._delete_channel),
+            ("POST", r"/channels/\{channel_id\}/invites", self._create_invite),
+        ]
+
+    # Handlers
+    def _create_guild(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        guild_id = next(self._ids)
+        placeholders = {}
+
+        roles = []
+        for index, role in enumerate(payload.get('roles') or [{"id": 0}]):
+            role_id = guild_id if index == 0 else next(self._ids)
+            placeholders[role.get('id')] = role_id
+            roles.append(self._role_data(role_id, {"name": "@everyone", **role} if index == 0 else role, position=index))
+
+        channels = []
+        requested = payload.get('channels')
+        if requested is None:
+            # Discord creates default channels for guilds built without any
+            requested = [
+                {"id": 1, "name": "Text Channels", "type": CHANNEL_CATEGORY},
+                {"id": 2, "name": "general", "type": CHANNEL_TEXT, "parent_id": 1},
+                {"id": 3, "name": "Voice Channels", "type": CHANNEL_CATEGORY},
+                {"id": 4, "name": "General", "type": CHANNEL_VOICE, "parent_id": 3},
+            ]
+        for channel in requested:
+            placeholders[("channel", channel.get('id'))] = next(self._ids)
+        for channel in requested:
+            channel_id = placeholders[("channel", channel.get('id'))]
+            data = dict(channel, parent_id=placeholders.get(("channel", channel.get('parent_id'))))
+            data["permission_overwrites"] = [
+                dict(overwrite, id=placeholders.get(overwrite.get('id'), overwrite.get('id')))
+                for overwrite in channel.get('permission_overwrites') or []
+            ]
+            channels.append(self._channel_data(channel_id, guild_id, data))
+
+        guild = {
+            "id": str(guild_id),
+            "name": payload.get('name'),
+            "icon": None,
+            "owner_id": str(self.bot.user.id),
+            "roles": roles,
+            "channels": channels,
+            "emojis": [],
+            "stickers": [],
+            "features": [],
+            "members": [],
+            "member_count": 1,
+            "voice_states": [],
+            "presences": [],
+            "threads": [],
+            "stage_instances": [],
+            "guild_scheduled_events": [],
+            "large": False,
+        }
+        self.guilds[guild_id] = guild
+        for channel in channels:
+            self.channels[int(channel["id"])] = channel
+        self._emit(self.bot._connection.parse_guild_create, guild)
+        # The REST response carries no channel list, those arrive over the gateway
+        return {key: value for key, value in guild.items() if key != "channels"}
+
+    def _get_guild(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in self._guild(params).items() if key != "channels"}
+
+    def _get_channels(self, params: Dict[str, int], payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(self._guild(params)["channels"])
+
+    def _create_channel(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        guild = self._guild(params)
+        parent = self.channels.get(int(payload.get('parent_id') or 0))
+        if parent and not payload.get('permission_overwrites'):
+            # Channels created in a category without overwrites sync to it
+            payload = dict(payload, permission_overwrites=parent["permission_overwrites"])
+        channel = self._channel_data(next(self._ids), int(guild["id"]), payload)
+        guild["channels"].append(channel)
+        self.channels[int(channel["id"])] = channel
+        self._emit(self.bot._connection.parse_channel_create, channel)
+        return channel
+
+    def _create_role(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        guild = self._guild(params)
+        role = self._role_data(next(self._ids), payload, position=1)
+        for existing in guild["roles"][1:]:
+            existing["position"] += 1
+        guild["roles"].append(role)
+        self._emit(self.bot._connection.parse_guild_role_create, {"guild_id": guild["id"], "role": role})
+        return role
+
+    def _move_channels(self, params: Dict[str, int], payload: List[Dict[str, Any]]) -> None:
+        self._guild(params)
+        for update in payload:
+            channel = self._channel(int(update["id"]))
+            if "position" in update:
+                channel["position"] = update["position"]
+            if "parent_id" in update:
+                channel["parent_id"] = str(update["parent_id"]) if update["parent_id"] else None
+            self._emit(self.bot._connection.parse_channel_update, channel)
+
+    def _edit_channel(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        channel = self._channel(params["channel_id"])
+        for field in ("name", "position"):
+            if field in payload:
+                channel[field] = payload[field]
+        if "permission_overwrites" in payload:
+            channel["permission_overwrites"] = [
+                dict(overwrite, id=str(overwrite['id'])) for overwrite in payload["permission_overwrites"]
+            ]
+        self._emit(self.bot._connection.parse_channel_update, channel)
+        return channel
+
+    def _delete_channel(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        channel = self.channels.pop(params["channel_id"], None)
+        if channel is None:
+            raise discord.NotFound(_FakeResponse(404), {"message": "Unknown Channel", "code": 10003})
+        guild = self.guilds[int(channel["guild_id"])]
+        guild["channels"].remove(channel)
+        # Discord moves the children of a deleted category to the top level
+        for child in guild["channels"]:
+            if child.get("parent_id") == channel["id"]:
+                child["parent_id"] = None
+        self._emit(self.bot._connection.parse_channel_delete, channel)
+        return channel
+
+    def _get_roles(self, params: Dict[str, int], payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(self._guild(params)["roles"])
+
+    def _move_roles(self, params: Dict[str, int], payload: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        guild = self._guild(params)
+        for update in payload:
+            role = self._role(guild, int(update["id"]))
+            role["position"] = update["position"]
+            self._emit(self.bot._connection.parse_guild_role_update, {"guild_id": guild["id"], "role": role})
+        return list(guild["roles"])
+
+    def _edit_role(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        guild = self._guild(params)
+        role = self._role(guild, params["role_id"])
+        for field in ("name", "hoist", "mentionable"):
+            if field in payload:
+                role[field] = payload[field]
+        if "colors" in payload or "color" in payload:
+            role.update(self._role_colors(payload))
+        if "permissions" in payload:
+            role["permissions"] = str(payload["permissions"])
+        self._emit(self.bot._connection.parse_guild_role_update, {"guild_id": guild["id"], "role": role})
+        return role
+
+    def _delete_role(self, params: Dict[str, int], payload: Dict[str, Any]) -> None:
+        guild = self._guild(params)
+        guild["roles"].remove(self._role(guild, params["role_id"]))
+        self._emit(self.bot._connection.parse_guild_role_delete, {"guild_id": guild["id"], "role_id": str(params["role_id"])})
+
+    def _create_invite(self, params: Dict[str, int], payload: Dict[str, Any]) -> Dict[str, Any]:
+        channel = self.channels.get(params["channel_id"])
+        if channel is None:
+            raise discord.NotFound(_FakeResponse(404), {"message": "Unknown Channel", "code": 10003})
+        guild = self.guilds[int(channel["guild_id"])]
+        return {
+            "code": format(next(self._ids), "x")[-10:],
+            "guild": {"id": guild["id"], "name": guild["name"], "features": [], "icon": None},
+            "channel": {"id": channel["id"], "name": channel["name"], "type": channel["type"]},
+            "max_age": payload.get('max_age', 0),
+            "max_uses": payload.get('max_uses', 0),
+            "temporary": False,
+            "uses": 0,
+        }
+
+    # Helpers
+    def _guild(self, params: Dict[str, int]) -> Dict[str, Any]:
+        guild = self.guilds.get(params.get("guild_id"))
+        if guild is None:
+            raise discord.NotFound(_FakeResponse(404), {"message": "Unknown Guild", "code": 10004})
+        return guild
+
+    def _channel(self, channel_id: int) -> Dict[str, Any]:
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            raise discord.NotFound(_FakeResponse(404), {"message": "Unknown Channel", "code": 10003})
+        return channel
+
+    def _role(self, guild: Dict[str, Any], role_id: int) -> Dict[str, Any]:
+        for role in guild["roles"]:
+            if int(role["id"]) == role_id:
+                return role
+        raise discord.NotFound(_FakeResponse(404), {"message": "Unknown Role", "code": 10011})
+
+    def _role_data(self, role_id: int, payload: Dict[str, Any], position: int) -> Dict[str, Any]:
+        return {
+            "id": str(role_id),
+            "name": payload.get('name', 'new role'),
+            **self._role_colors(payload),
+            "hoist": payload.get('hoist', False),
+            "position": position,
+            "permissions": str(payload.get('permissions', 0)),
+            "managed": False,
+            "mentionable": payload.get('mentionable', False),
+        }
+
+    @staticmethod
+    def _role_colors(payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Both color fields Discord returns, from a payload with either one
+
+        discord.py 2.6 and later send colors.primary_color and read the role's
+        color from there; older clients and raw calls send color.
+        """
+        colors = payload.get('colors') or {}
+        color = colors.get('primary_color', payload.get('color')) or 0
+        return {
+            "color": color,
+            "colors": {
+                "primary_color": color,
+                "secondary_color": colors.get('secondary_color'),
+                "tertiary_color": colors.get('tertiary_color'),
+            },
+        }
+
+    def _channel_data(self, channel_id: int, guild_id: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+        data = {
+            "id": str(channel_id),
+            "guild_id": str(guild_id),
+            "type": payload.get('type', CHANNEL_TEXT),
+            "name": payload.get('name'),
+            "position": payload.get('position', 0),
+            "parent_id": str(payload['parent_id']) if payload.get('parent_id') else None,
+            "permission_overwrites": [
+                dict(overwrite, id=str(overwrite['id'])) for overwrite in payload.get('permission_overwrites') or []
+            ],
+            "nsfw": False,
+        }
+        if data["type"] == CHANNEL_VOICE:
+            data.update(bitrate=64000, user_limit=0)
+        return data
+
+    def _emit(self, parser: Callable[[Dict[str, Any]], None], data: Dict[str, Any]):
+        """Deliver a gateway event shortly after the REST response, like the real gateway"""
+        asyncio.get_running_loop().call_later(self.gateway_delay, parser, data)
+
+
+class _FakeResponse:
+    """Minimal aiohttp response shape for discord.HTTPException"""
+
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "Simulated"
+        self.headers: Dict[str, str] = {}
+
+
+async def run_simulated_bot(bot: discord.Client, simulator: DiscordSimulator):
+    """Stand in for bot.start(): install the simulator, fire on_ready and stay up"""
+    await simulator.install(bot)
+    bot.dispatch('ready')
+    closed = asyncio.Event()
+    original_close = bot.close
+
+    async def close():
+        closed.set()
+        await original_close()
+
+    bot.close = close
+    await closed.wait()
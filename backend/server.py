@@ -1,278 +1,2641 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Query, Response, Request, Depends, Header
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.datastructures import Headers, MutableHeaders
 import os
 import logging
 import json
 import asyncio
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Awaitable, Callable, Literal, Tuple, Union
+from collections import OrderedDict
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import discord
 from discord.ext import commands
-import threading
-import queue
+import time
+import random
+import contextlib
+import base64
+import codecs
+import re
+import tempfile
+import zipfile
+import socket
+import hashlib
+import gzip
+import zlib
+from pymongo import ReturnDocument, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+import contextvars
+import aiohttp
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer(__name__)
+except ImportError:  # Tracing is optional
+    tracer = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack responses are optional
+    msgpack = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Metrics and tracing
+QUEUE_WAIT_SECONDS = Histogram(
+    "server_creation_queue_wait_seconds",
+    "Time server creation jobs wait for a worker",
+)
+BUILD_SECONDS = Histogram(
+    "server_creation_build_seconds",
+    "End-to-end guild build duration",
+    ["template_size", "outcome"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+DISCORD_REQUEST_SECONDS = Histogram(
+    "discord_request_seconds",
+    "Discord REST call latency by kind, excluding local rate limit waits",
+    ["kind", "outcome"],
+)
+DISCORD_RATE_LIMITED = Counter(
+    "discord_rate_limited_total",
+    "429 responses from Discord, which discord.py retries",
+    ["scope"],
+)
+DISCORD_RETRIES = Counter(
+    "discord_retries_total",
+    "Discord calls retried by the build retry layer, by kind",
+    ["kind"],
+)
+DISCORD_CIRCUIT_TRIPS = Counter(
+    "discord_circuit_trips_total",
+    "Times Discord's global rate limit paused the creation pipeline",
+)
+RATE_LIMIT_SLEEP_SECONDS = Counter(
+    "discord_rate_limit_sleep_seconds_total",
+    "Time spent sleeping on rate limits, locally or on Discord's Retry-After",
+    ["source"],
+)
+MONGO_QUERY_SECONDS = Histogram(
+    "mongo_query_seconds",
+    "MongoDB operation latency by API endpoint",
+    ["endpoint", "collection", "operation"],
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "response_cache_requests",
+    "Cacheable API requests by route and outcome (hit, miss, not_modified)",
+    ["route", "result"],
+)
+
+# API route currently being served, used to label Mongo latency
+current_endpoint: contextvars.ContextVar = contextvars.ContextVar("current_endpoint", default="background")
+
+def start_span(name: str, **attributes):
+    """Start an OpenTelemetry span when tracing is installed"""
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+def template_size_bucket(template: "DiscordTemplate") -> str:
+    size = len(template.roles) + len(template.channels)
+    if size <= 10:
+        return "small"
+    if size <= 50:
+        return "medium"
+    return "large"
+
+def record_discord_rate_limit(scope: str, retry_after: float):
+    DISCORD_RATE_LIMITED.labels(scope).inc()
+    RATE_LIMIT_SLEEP_SECONDS.labels("discord").inc(retry_after)
+    if scope == "global":
+        discord_circuit.trip(retry_after)
+
+async def on_discord_response(session, context, params):
+    """Count Discord 429s and the Retry-After time discord.py sleeps on"""
+    if params.response.status == 429:
+        headers = params.response.headers
+        scope = headers.get("X-RateLimit-Scope") or ("global" if headers.get("X-RateLimit-Global") else "user")
+        record_discord_rate_limit(scope, float(headers.get("Retry-After") or 0))
+
+discord_http_trace = aiohttp.TraceConfig()
+discord_http_trace.on_request_end.append(on_discord_response)
+
+class InstrumentedCursor:
+    """Motor cursor wrapper that times to_list"""
+
+    def __init__(self, cursor, collection: str, operation: str):
+        self._cursor = cursor
+        self._collection = collection
+        self._operation = operation
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._cursor = self._cursor.limit(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._cursor = self._cursor.skip(*args, **kwargs)
+        return self
+
+    async def to_list(self, length: Optional[int]):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length)
+        finally:
+            MONGO_QUERY_SECONDS.labels(current_endpoint.get(), self._collection, self._operation).observe(time.perf_counter() - start)
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class InstrumentedCollection:
+    """Motor collection wrapper that records query latency per API endpoint"""
+
+    TIMED_METHODS = {
+        "find_one", "find_one_and_update", "find_one_and_delete", "count_documents",
+        "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "bulk_write", "create_index",
+    }
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self.TIMED_METHODS:
+            return self._timed(name, attr)
+        if name in ("find", "aggregate"):
+            return lambda *args, **kwargs: InstrumentedCursor(attr(*args, **kwargs), self._collection.name, name)
+        return attr
+
+    def _timed(self, operation: str, method):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                MONGO_QUERY_SECONDS.labels(current_endpoint.get(), self._collection.name, operation).observe(time.perf_counter() - start)
+        return timed
+
+class InstrumentedDatabase:
+    """Motor database wrapper handing out instrumented collections"""
+
+    def __init__(self, client, name: str):
+        self._client = client
+        self._name = name
+        self._collections: Dict[str, InstrumentedCollection] = {}
+
+    @property
+    def _database(self):
+        return self._client[self._name]
+
+    async def command(self, *args, **kwargs):
+        return await self._database.command(*args, **kwargs)
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        if name not in self._collections:
+            self._collections[name] = InstrumentedCollection(self._database[name])
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> InstrumentedCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+# MongoDB connection
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '20000'))
+# 0 leaves socket reads without a timeout
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '0'))
+MONGO_WRITE_CONCERN = os.environ.get('MONGO_WRITE_CONCERN', '1')
+MONGO_WRITE_TIMEOUT_MS = int(os.environ.get('MONGO_WRITE_TIMEOUT_MS', '0'))
+
+mongo_url = os.environ['MONGO_URL']
+mongo_options = {
+    "maxPoolSize": MONGO_MAX_POOL_SIZE,
+    "minPoolSize": MONGO_MIN_POOL_SIZE,
+    "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+    "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS or None,
+    "w": int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN,
+}
+if MONGO_WRITE_TIMEOUT_MS:
+    mongo_options["wTimeoutMS"] = MONGO_WRITE_TIMEOUT_MS
+
+class LazyMongoClient:
+    """Creates the Motor client on first use, so importing the app doesn't load Motor or resolve the Mongo URL"""
+
+    def __init__(self, url: str, **options):
+        self.url = url
+        self.options = options
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            self._client = AsyncIOMotorClient(self.url, **self.options)
+        return self._client
+
+    def __getitem__(self, name: str):
+        return self.client[name]
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+client = LazyMongoClient(mongo_url, **mongo_options)
+db = InstrumentedDatabase(client, os.environ['DB_NAME'])
+
+# Discord Bot setup
+intents = discord.Intents.default()
+intents.guilds = True
+intents.guild_messages = True
+# One gateway shard per bot worker; unset runs a single unsharded session
+DISCORD_SHARD_COUNT = int(os.environ['DISCORD_SHARD_COUNT']) if os.environ.get('DISCORD_SHARD_COUNT') else None
+DISCORD_SHARD_ID = int(os.environ.get('DISCORD_SHARD_ID', '0')) if DISCORD_SHARD_COUNT else None
+bot = commands.Bot(
+    command_prefix='!', intents=intents, http_trace=discord_http_trace,
+    shard_id=DISCORD_SHARD_ID, shard_count=DISCORD_SHARD_COUNT,
+)
+
+# Global variables for bot status
+bot_ready = False
+# Set once the bot has logged in; await it instead of polling bot_ready. Builds are
+# admitted from then on, since REST calls keep working while the gateway reconnects
+bot_ready_event = asyncio.Event()
+# Set while the gateway session is up, for /readyz
+bot_connected_event = asyncio.Event()
+bot_user = None
+
+# Seconds an API request waits for a server creation job to finish
+SERVER_CREATION_TIMEOUT = 60
+# Seconds to wait for the gateway to report a newly created guild
+GUILD_AVAILABLE_TIMEOUT = 5
+# Seconds a background server creation job may run before it is marked failed
+SERVER_CREATION_JOB_TIMEOUT = int(os.environ.get('SERVER_CREATION_JOB_TIMEOUT', '600'))
+# How long startup waits for the bot to log in, and shutdown waits for running builds
+BOT_READY_TIMEOUT = float(os.environ.get('BOT_READY_TIMEOUT', '30'))
+# Seconds /readyz waits for Mongo to answer a ping
+READINESS_MONGO_TIMEOUT = float(os.environ.get('READINESS_MONGO_TIMEOUT', '2'))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', '60'))
+INVITE_CACHE_SIZE = int(os.environ.get('INVITE_CACHE_SIZE', '1024'))
+INVITE_CACHE_TTL = float(os.environ.get('INVITE_CACHE_TTL', '3600'))
+# Log writes are buffered and flushed together once either threshold is reached
+LOG_WRITE_BATCH_SIZE = int(os.environ.get('LOG_WRITE_BATCH_SIZE', '100'))
+LOG_WRITE_FLUSH_INTERVAL = float(os.environ.get('LOG_WRITE_FLUSH_INTERVAL', '1'))
+# Failed log writes are retried with doubling delays up to the max; past the cap the oldest are dropped
+LOG_WRITE_MAX_PENDING = int(os.environ.get('LOG_WRITE_MAX_PENDING', '10000'))
+LOG_WRITE_MAX_BACKOFF = float(os.environ.get('LOG_WRITE_MAX_BACKOFF', '60'))
+# Status checks expire after this many seconds; upsert mode keeps one document per client
+STATUS_CHECK_TTL = int(os.environ.get('STATUS_CHECK_TTL', str(7 * 24 * 3600)))
+STATUS_CHECK_UPSERT = os.environ.get('STATUS_CHECK_UPSERT', 'false').lower() == 'true'
+# "local" runs builds on this process's bot, "mongo" hands them to bot_worker.py processes
+SERVER_CREATION_QUEUE = os.environ.get('SERVER_CREATION_QUEUE', 'local').lower()
+# Seconds a worker holds a claimed job before others may take it over
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '2'))
+# Parsed template cache settings
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', '128'))
+TEMPLATE_CACHE_TTL = float(os.environ.get('TEMPLATE_CACHE_TTL', '300'))
+TEMPLATE_CACHE_CHANGE_STREAM = os.environ.get('TEMPLATE_CACHE_CHANGE_STREAM', 'false').lower() == 'true'
+# Most-used templates loaded into the cache at startup
+TEMPLATE_CACHE_PREWARM = int(os.environ.get('TEMPLATE_CACHE_PREWARM', '10'))
+# Seconds between pulls of usage counters recorded by other replicas and workers
+TEMPLATE_STATS_REFRESH_INTERVAL = float(os.environ.get('TEMPLATE_STATS_REFRESH_INTERVAL', '30'))
+# Template upload limits
+TEMPLATE_UPLOAD_MAX_BYTES = int(os.environ.get('TEMPLATE_UPLOAD_MAX_BYTES', str(1024 * 1024)))
+# Room for the multipart boundaries and part headers around an uploaded template
+TEMPLATE_UPLOAD_MULTIPART_OVERHEAD = 16 * 1024
+TEMPLATE_BULK_MAX_BYTES = int(os.environ.get('TEMPLATE_BULK_MAX_BYTES', str(50 * 1024 * 1024)))
+TEMPLATE_BULK_BATCH_SIZE = int(os.environ.get('TEMPLATE_BULK_BATCH_SIZE', '100'))
+# Store channels, roles and build plan zlib-compressed above this size, 0 disables
+TEMPLATE_COMPRESS_MIN_BYTES = int(os.environ.get('TEMPLATE_COMPRESS_MIN_BYTES', str(16 * 1024)))
+# Gzip list responses at least this large when the client accepts it
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', '1024'))
+# "memory" caches read responses per process, "redis" shares them between replicas, "off" disables
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory').lower()
+RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '1024'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Answer Discord calls with the offline simulator instead of logging in
+DISCORD_SIMULATOR = os.environ.get('DISCORD_SIMULATOR', 'false').lower() == 'true'
+# Create roles and channels in the create guild call; every compiled plan fits its payload
+DISCORD_GUILD_BOOTSTRAP = os.environ.get('DISCORD_GUILD_BOOTSTRAP', 'true').lower() == 'true'
+
+# Server creation worker pool and Discord rate limit settings
+SERVER_CREATION_CONCURRENCY = int(os.environ.get('SERVER_CREATION_CONCURRENCY', '4'))
+SERVER_CREATION_MAX_PENDING = int(os.environ.get('SERVER_CREATION_MAX_PENDING', '100'))
+SERVER_CREATION_BATCH_MAX = int(os.environ.get('SERVER_CREATION_BATCH_MAX', '50'))
+DISCORD_GLOBAL_RATE_LIMIT = int(os.environ.get('DISCORD_GLOBAL_RATE_LIMIT', '50'))
+DISCORD_GLOBAL_RATE_PERIOD = float(os.environ.get('DISCORD_GLOBAL_RATE_PERIOD', '1'))
+DISCORD_ROUTE_RATE_LIMIT = int(os.environ.get('DISCORD_ROUTE_RATE_LIMIT', '5'))
+DISCORD_ROUTE_RATE_PERIOD = float(os.environ.get('DISCORD_ROUTE_RATE_PERIOD', '1'))
+DISCORD_ROUTE_CONCURRENCY = int(os.environ.get('DISCORD_ROUTE_CONCURRENCY', '2'))
+# Retries of transient Discord failures: per call, per build, and the backoff bounds for 5xx
+DISCORD_RETRY_MAX_ATTEMPTS = int(os.environ.get('DISCORD_RETRY_MAX_ATTEMPTS', '3'))
+DISCORD_BUILD_RETRY_BUDGET = int(os.environ.get('DISCORD_BUILD_RETRY_BUDGET', '10'))
+DISCORD_RETRY_BASE_DELAY = float(os.environ.get('DISCORD_RETRY_BASE_DELAY', '0.5'))
+DISCORD_RETRY_MAX_DELAY = float(os.environ.get('DISCORD_RETRY_MAX_DELAY', '30'))
+
+# Create the main app without a prefix
+app = FastAPI()
+
+async def track_endpoint(request: Request):
+    """Label Mongo metrics with the route being served"""
+    route = request.scope.get("route")
+    current_endpoint.set(route.path if route else request.url.path)
+
+# Create a router with the /api prefix
+api_router = APIRouter(prefix="/api", dependencies=[Depends(track_endpoint)])
+
+# Pydantic Models
+class StatusCheck(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    client_name: str
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    # Heartbeats folded into this document when status checks are upserted per client
+    count: int = 1
+
+class StatusCheckCreate(BaseModel):
+    client_name: str
+
+class StatusCheckSummary(BaseModel):
+    client_name: str
+    last_seen: datetime
+    count: int
+
+class DiscordChannel(BaseModel):
+    name: str
+    type: str  # "text", "voice", "category"
+    category: Optional[str] = None
+    position: Optional[int] = 0
+    permissions: Optional[Dict[str, Any]] = {}
+
+class DiscordRole(BaseModel):
+    name: str
+    color: Optional[str] = "#000000"
+    permissions: Optional[int] = 0
+    mentionable: Optional[bool] = True
+    hoist: Optional[bool] = False
+
+class DiscordTemplate(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: Optional[str] = ""
+    icon_url: Optional[str] = None
+    channels: List[DiscordChannel]
+    roles: List[DiscordRole]
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_by: Optional[str] = None
+    # Hash of the normalized content; identical uploads share one stored template
+    content_hash: Optional[str] = None
+    # Uploads with the same name are numbered as versions of one template
+    version: int = 1
+
+class PlannedRole(BaseModel):
+    name: str
+    color: int = 0
+    permissions: int = 0
+    mentionable: bool = True
+    hoist: bool = False
+
+class PlannedChannel(BaseModel):
+    name: str
+    type: str
+    position: int = 0
+    # Role name -> {"allow": bits, "deny": bits}; empty in a category means synced to it
+    permissions: Dict[str, Any] = {}
+
+class ChannelGroup(BaseModel):
+    category: Optional[PlannedChannel] = None
+    channels: List[PlannedChannel] = []
+
+class BuildPlan(BaseModel):
+    roles: List[PlannedRole] = []
+    groups: List[ChannelGroup] = []
+
+class DiscordTemplateSummary(BaseModel):
+    id: str
+    name: str
+    description: Optional[str] = ""
+    icon_url: Optional[str] = None
+    created_at: datetime
+    created_by: Optional[str] = None
+    content_hash: Optional[str] = None
+    version: int = 1
+
+class TemplateStatsSummary(BaseModel):
+    template_id: str
+    name: Optional[str] = None
+    uses: int
+    failures: int
+    avg_build_seconds: float
+    last_used_at: datetime
+
+class ServerCreationRequest(BaseModel):
+    template_id: str
+    server_name: str
+    # Retrying with the same key resumes the earlier build instead of starting a new guild
+    idempotency_key: Optional[str] = None
+
+class ServerBatchCreationRequest(BaseModel):
+    template_id: str
+    server_names: List[str]
+    # Each build gets "<key>:<index>", so retrying the batch resumes its unfinished builds
+    idempotency_key: Optional[str] = None
+
+class ServerCreationResponse(BaseModel):
+    success: bool
+    server_id: Optional[str] = None
+    invite_link: Optional[str] = None
+    # The invite is created after the build returns; fetch it from /servers/{id}/invite
+    invite_pending: bool = False
+    message: str
+    idempotency_key: Optional[str] = None
+    # Build steps that only succeeded, or finally failed, after retrying
+    retried_steps: List[str] = []
+
+class ServerSyncRequest(BaseModel):
+    # Defaults to the template the server was created from
+    template_id: Optional[str] = None
+    delete_extra: bool = True
+    dry_run: bool = False
+
+class SyncOperation(BaseModel):
+    action: str  # "create", "edit", "move", "delete"
+    kind: str  # "role", "category", "channel"
+    name: str
+    id: Optional[str] = None
+    changes: Dict[str, Any] = {}
+
+class ServerSyncResponse(BaseModel):
+    success: bool
+    server_id: str
+    message: str
+    operations: List[SyncOperation] = []
+    errors: List[str] = []
+
+class ServerCreationJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    template_id: str
+    server_name: str
+    status: str = "queued"  # "queued", "running", "completed", "failed"
+    idempotency_key: Optional[str] = None
+    steps: List[Dict[str, Any]] = []
+    result: Optional[ServerCreationResponse] = None
+    attempts: int = 0
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Discord rate limiting
+class TokenBucket:
+    """Token bucket allowing `rate` calls per `period` seconds"""
+
+    def __init__(self, rate: int, period: float):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+class DiscordRateLimiter:
+    """Models Discord's global bucket plus one bucket per route and major parameter
+
+    A route bucket nobody is using is dropped once it has been idle for a
+    full period, by which time it has refilled and matches a fresh one.
+    """
+
+    def __init__(self, global_rate: int, global_period: float, route_rate: int, route_period: float, route_concurrency: int):
+        self.global_bucket = TokenBucket(global_rate, global_period)
+        self.route_rate = route_rate
+        self.route_period = route_period
+        self.route_concurrency = route_concurrency
+        self.route_buckets: Dict[tuple, TokenBucket] = {}
+        self.route_slots: Dict[tuple, asyncio.Semaphore] = {}
+        # Callers holding or waiting for a slot on each route
+        self.route_users: Dict[tuple, int] = {}
+        self.total_wait_time = 0.0
+        self._evicted_at = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def limit(self, route: str, major_id: Optional[int] = None):
+        """Wait for a free slot and token on the route, then on the global bucket"""
+        key = (route, major_id)
+        self._evict_idle()
+        if key not in self.route_buckets:
+            self.route_buckets[key] = TokenBucket(self.route_rate, self.route_period)
+            self.route_slots[key] = asyncio.Semaphore(self.route_concurrency)
+            self.route_users[key] = 0
+
+        self.route_users[key] += 1
+        try:
+            # The per-route semaphore applies backpressure to callers sharing a bucket
+            async with self.route_slots[key]:
+                start = time.monotonic()
+                await self.route_buckets[key].acquire()
+                await self.global_bucket.acquire()
+                waited = time.monotonic() - start
+                self.total_wait_time += waited
+                RATE_LIMIT_SLEEP_SECONDS.labels("local").inc(waited)
+                yield
+        finally:
+            self.route_users[key] -= 1
+
+    def _evict_idle(self):
+        """Drop unused route buckets that have been idle for a period, at most once a period"""
+        now = time.monotonic()
+        if now - self._evicted_at < self.route_period:
+            return
+        self._evicted_at = now
+        idle = [
+            key for key, bucket in self.route_buckets.items()
+            if not self.route_users[key] and now - bucket.updated >= self.route_period
+        ]
+        for key in idle:
+            del self.route_buckets[key]
+            del self.route_slots[key]
+            del self.route_users[key]
+
+rate_limiter = DiscordRateLimiter(
+    DISCORD_GLOBAL_RATE_LIMIT,
+    DISCORD_GLOBAL_RATE_PERIOD,
+    DISCORD_ROUTE_RATE_LIMIT,
+    DISCORD_ROUTE_RATE_PERIOD,
+    DISCORD_ROUTE_CONCURRENCY,
+)
+
+# Rate limit bucket used by each kind of Discord call
+DISCORD_ROUTES = {
+    "create_guild": "create_guild",
+    "create_role": "create_role",
+    "create_category": "create_channel",
+    "create_text_channel": "create_channel",
+    "create_voice_channel": "create_channel",
+    "create_invite": "create_invite",
+    "fetch_roles": "fetch_roles",
+    "fetch_channels": "fetch_channels",
+    "edit_role": "edit_role",
+    "move_roles": "move_roles",
+    "delete_role": "delete_role",
+    "edit_channel": "edit_channel",
+    "move_channels": "move_channels",
+    "delete_channel": "delete_channel",
+}
+
+class DiscordCircuitBreaker:
+    """Holds back every Discord call while Discord's global rate limit is in effect"""
+
+    def __init__(self):
+        self.open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.open_until > time.monotonic()
+
+    def trip(self, retry_after: float):
+        open_until = time.monotonic() + retry_after
+        if open_until > self.open_until:
+            if not self.is_open:
+                DISCORD_CIRCUIT_TRIPS.inc()
+                logger.warning(f"Discord global rate limit hit, pausing server creation for {retry_after:.2f}s")
+            self.open_until = open_until
+
+    async def wait(self):
+        while self.is_open:
+            await asyncio.sleep(self.open_until - time.monotonic())
+
+discord_circuit = DiscordCircuitBreaker()
+
+class RetryBudget:
+    """Retries one build may spend across all of its Discord calls"""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self.retried_steps: List[str] = []
+
+    def spend(self, step: str) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        if step not in self.retried_steps:
+            self.retried_steps.append(step)
+        return True
+
+# 5xx statuses discord.py's HTTPClient already retries with backoff before raising
+DISCORD_PY_RETRIED_STATUSES = {500, 502, 504, 524}
+
+# Calls that may have been applied even though they failed with a 5xx or network error
+DISCORD_NON_IDEMPOTENT = {"create_guild", "create_role", "create_category", "create_text_channel", "create_voice_channel"}
+
+def discord_rate_limited(error: Exception) -> bool:
+    """Whether Discord refused the call outright, so it certainly wasn't applied"""
+    return isinstance(error, discord.RateLimited) or (isinstance(error, discord.HTTPException) and error.status == 429)
+
+def discord_retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a failed Discord call, or None if retrying won't help"""
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.HTTPException):
+        if error.status == 429:
+            retry_after = getattr(error.response, "headers", {}).get("Retry-After")
+            if retry_after:
+                return float(retry_after)
+        elif error.status < 500 or error.status in DISCORD_PY_RETRIED_STATUSES:
+            return None
+    elif not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError)):
+        return None
+    # Full jitter keeps builds that failed together from retrying together
+    return random.uniform(0, min(DISCORD_RETRY_MAX_DELAY, DISCORD_RETRY_BASE_DELAY * 2 ** attempt))
+
+@contextlib.asynccontextmanager
+async def discord_request(kind: str, major_id: Optional[int] = None):
+    """Rate limit, time and trace a single Discord REST call"""
+    await discord_circuit.wait()
+    async with rate_limiter.limit(DISCORD_ROUTES[kind], major_id):
+        outcome = "success"
+        start = time.perf_counter()
+        with start_span(f"discord.{kind}", major_id=str(major_id)):
+            try:
+                yield
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                DISCORD_REQUEST_SECONDS.labels(kind, outcome).observe(time.perf_counter() - start)
+
+async def discord_call(kind: str, major_id: Optional[int], call: Callable[[], Awaitable[Any]], retry: Optional[RetryBudget] = None, step: Optional[str] = None, lookup: Optional[Callable[[], Awaitable[Any]]] = None) -> Any:
+    """Make a Discord call under discord_request, retrying 429s, 5xx and network errors out of the budget
+
+    Discord may have applied a DISCORD_NON_IDEMPOTENT call even though it
+    failed with a 5xx or network error. Those are only retried when lookup,
+    which searches the guild for the object, comes back empty; its result is
+    returned when it finds one. Without a lookup only 429s are retried.
+    """
+    attempt = 0
+    while True:
+        try:
+            async with discord_request(kind, major_id):
+                return await call()
+        except Exception as e:
+            delay = discord_retry_delay(e, attempt)
+            if delay is None or attempt >= DISCORD_RETRY_MAX_ATTEMPTS or retry is None:
+                raise
+            if kind in DISCORD_NON_IDEMPOTENT and not discord_rate_limited(e):
+                if lookup is None:
+                    raise
+                try:
+                    found = await lookup()
+                except Exception:
+                    raise e
+                if found is not None:
+                    logger.info(f"{step or kind} was created despite: {e}")
+                    return found
+            if not retry.spend(step or kind):
+                raise
+            logger.info(f"Retrying {step or kind} in {delay:.2f}s after: {e}")
+        attempt += 1
+        DISCORD_RETRIES.labels(kind).inc()
+        await asyncio.sleep(delay)
+
+# Server creation dispatcher
+class ServerCreationDispatcher:
+    """Runs server creation jobs on a bounded worker pool next to the bot"""
+
+    def __init__(self, concurrency: int, max_pending: int):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # Builds running under an idempotency key, so a retry joins the running build
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.accepting = False
+        self.queue_depth = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def start(self):
+        """Start the worker pool on the running event loop"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.accepting = True
+
+    async def drain(self, timeout: float):
+        """Stop taking jobs and give queued and running builds time to finish"""
+        self.accepting = False
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {self.queue_depth + self.in_progress} server creation jobs unfinished")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.in_progress + self.completed
+        return {
+            "workers": self.concurrency,
+            "queue_depth": self.queue_depth,
+            "in_progress": self.in_progress,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_time": self.total_wait_time / started if started else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "rate_limit_wait_time": rate_limiter.total_wait_time,
+        }
+
+    async def _worker(self):
+        while True:
+            template, server_name, progress, plan, idempotency_key, submitted_at, future = await self._queue.get()
+            # Hold queued builds while Discord's global limit is in effect rather than failing them
+            await discord_circuit.wait()
+            wait_time = time.monotonic() - submitted_at
+            QUEUE_WAIT_SECONDS.observe(wait_time)
+            self.queue_depth -= 1
+            self.in_progress += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            start = time.perf_counter()
+            try:
+                with start_span("server_creation.build", template_id=template.id, server_name=server_name):
+                    result = await create_discord_server_internal(template, server_name, progress, plan=plan, idempotency_key=idempotency_key)
+            except Exception as e:
+                logger.exception(f"Server creation worker failed for template {template.id}")
+                result = ServerCreationResponse(
+                    success=False,
+                    message=f"Worker error: {str(e)}"
+                )
+            finally:
+                self.in_progress -= 1
+                self.completed += 1
+                self._queue.task_done()
+            BUILD_SECONDS.labels(
+                template_size_bucket(template), "success" if result.success else "failure"
+            ).observe(time.perf_counter() - start)
+            logger.info(
+                f"Server creation finished: template={template.id} server_id={result.server_id} "
+                f"success={result.success} duration={time.perf_counter() - start:.2f}s wait={wait_time:.2f}s"
+            )
+            if not future.done():
+                future.set_result(result)
+
+    async def submit(self, template: DiscordTemplate, server_name: str, progress: Optional[Callable[[str, Dict[str, Any]], None]] = None, timeout: float = SERVER_CREATION_TIMEOUT, plan: Optional[BuildPlan] = None, idempotency_key: Optional[str] = None) -> ServerCreationResponse:
+        """Queue a server creation job and wait for its result"""
+        idempotency_key = idempotency_key or str(uuid.uuid4())
+        future = self._in_flight.get(idempotency_key)
+        if future is None:
+            future = self._enqueue(template, server_name, progress, plan, idempotency_key)
+            if isinstance(future, ServerCreationResponse):
+                return future
+
+        try:
+            # Shield the job so a timed out request doesn't abort a half-built guild
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return ServerCreationResponse(
+                success=False,
+                message="Server creation timed out. Please try again.",
+                idempotency_key=idempotency_key
+            )
+
+    def _enqueue(self, template: DiscordTemplate, server_name: str, progress: Optional[Callable[[str, Dict[str, Any]], None]], plan: Optional[BuildPlan], idempotency_key: str) -> Union[asyncio.Future, ServerCreationResponse]:
+        if not self.accepting or not bot_ready_event.is_set():
+            return ServerCreationResponse(
+                success=False,
+                message="Discord bot is not ready. Please try again."
+            )
+
+        if self.queue_depth >= self.max_pending:
+            self.rejected += 1
+            return ServerCreationResponse(
+                success=False,
+                message="Server creation queue is full. Please try again later."
+            )
+        self.queue_depth += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[idempotency_key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(idempotency_key, None))
+        self._queue.put_nowait((template, server_name, progress, plan, idempotency_key, time.monotonic(), future))
+        return future
+
+server_creation_dispatcher = ServerCreationDispatcher(SERVER_CREATION_CONCURRENCY, SERVER_CREATION_MAX_PENDING)
+
+# Discord Bot Events
+@bot.event
+async def on_ready():
+    global bot_ready, bot_user
+    bot_ready = True
+    bot_user = bot.user
+    bot_ready_event.set()
+    bot_connected_event.set()
+    logger.info(f'{bot.user} has logged in to Discord!')
+
+@bot.event
+async def on_resumed():
+    bot_connected_event.set()
+    logger.info("Discord gateway session resumed")
+
+@bot.event
+async def on_disconnect():
+    # discord.py reconnects by itself; builds keep being admitted in the meantime
+    bot_connected_event.clear()
+    logger.warning("Discord gateway disconnected")
+
+# Discord Bot Functions
+CHANNEL_TYPES = {"text": 0, "voice": 2, "category": 4}
+ROLE_COLOR_PATTERN = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+EVERYONE = "@everyone"
+
+def compile_overwrite(value: Any) -> Tuple[int, int]:
+    """Turn one template overwrite into its allow and deny permission bits
+
+    Accepts {"allow": bits, "deny": bits} or permission flags such as
+    {"view_channel": false, "send_messages": true}.
+    """
+    if not isinstance(value, dict):
+        raise ValueError("must be an object")
+    if set(value) <= {"allow", "deny"}:
+        allow, deny = int(value.get("allow") or 0), int(value.get("deny") or 0)
+        max_permissions = discord.Permissions.all().value
+        if not (0 <= allow <= max_permissions and 0 <= deny <= max_permissions):
+            raise ValueError("has invalid permission bits")
+        return allow, deny
+    allow, deny = discord.PermissionOverwrite(**value).pair()
+    return allow.value, deny.value
+
+def compile_permissions(channel: DiscordChannel, role_names: set, errors: List[str]) -> Dict[str, Any]:
+    """Validate a channel's overwrites and key them by role name"""
+    permissions = {}
+    for target, value in (channel.permissions or {}).items():
+        name = EVERYONE if target.lower() == EVERYONE else target
+        if name != EVERYONE and name not in role_names:
+            errors.append(f"Channel '{channel.name}' has permissions for unknown role '{target}'")
+            continue
+        try:
+            allow, deny = compile_overwrite(value)
+        except (ValueError, TypeError) as e:
+            errors.append(f"Channel '{channel.name}' permissions for '{target}' {e}")
+            continue
+        if allow or deny:
+            permissions[name] = {"allow": allow, "deny": deny}
+    return permissions
+
+def collapse_overwrites(group: ChannelGroup):
+    """Move overwrites shared by every channel of a category onto the category
+
+    Channels created in a category without overwrites sync to it, so the
+    shared overwrites are sent once instead of on every channel.
+    """
+    if not group.category or not group.channels:
+        return
+    if not group.category.permissions:
+        first = group.channels[0].permissions
+        if first and all(channel.permissions == first for channel in group.channels):
+            group.category.permissions = first
+    for channel in group.channels:
+        if channel.permissions == group.category.permissions:
+            channel.permissions = {}
+
+def compile_template(template: DiscordTemplate) -> Tuple[BuildPlan, List[str]]:
+    """Compile a template into a validated, ordered build plan
+
+    Roles keep their template order so the hierarchy is preserved, categories
+    and the channels inside each category are sorted by position. Items with
+    errors are left out of the plan and described in the returned list.
+    """
+    errors = []
+    max_permissions = discord.Permissions.all().value
+
+    roles = []
+    role_names = set()
+    for role in template.roles:
+        if role.name.lower() == "@everyone":  # Skip @everyone role
+            continue
+        if role.name in role_names:
+            errors.append(f"Duplicate role '{role.name}'")
+            continue
+        if role.color and not ROLE_COLOR_PATTERN.match(role.color):
+            errors.append(f"Role '{role.name}' has invalid color '{role.color}'")
+            continue
+        if not 0 <= (role.permissions or 0) <= max_permissions:
+            errors.append(f"Role '{role.name}' has invalid permissions {role.permissions}")
+            continue
+        role_names.add(role.name)
+        roles.append(PlannedRole(
+            name=role.name,
+            color=int(role.color[1:], 16) if role.color else 0,
+            permissions=role.permissions or 0,
+            mentionable=role.mentionable if role.mentionable is not None else True,
+            hoist=bool(role.hoist),
+        ))
+
+    groups: Dict[Optional[str], ChannelGroup] = {None: ChannelGroup()}
+    members = []
+    for channel in template.channels:
+        if channel.type not in CHANNEL_TYPES:
+            errors.append(f"Channel '{channel.name}' has unknown type '{channel.type}'")
+            continue
+        planned = PlannedChannel(
+            name=channel.name,
+            type=channel.type,
+            position=channel.position or 0,
+            permissions=compile_permissions(channel, role_names, errors),
+        )
+        if channel.type != "category":
+            members.append((channel.category, planned))
+        elif channel.name in groups:
+            errors.append(f"Duplicate category '{channel.name}'")
+        else:
+            groups[channel.name] = ChannelGroup(category=planned)
+
+    # Categories may be declared after the channels that reference them
+    for category_name, planned in members:
+        if category_name and category_name not in groups:
+            errors.append(f"Channel '{planned.name}' references unknown category '{category_name}'")
+            continue
+        group = groups[category_name or None]
+        if any(existing.name == planned.name and existing.type == planned.type for existing in group.channels):
+            errors.append(f"Duplicate channel '{planned.name}' in category '{category_name or 'none'}'")
+            continue
+        group.channels.append(planned)
+
+    for group in groups.values():
+        group.channels.sort(key=lambda channel: channel.position)
+        collapse_overwrites(group)
+    ordered_groups = [groups[None]] + sorted(
+        (group for name, group in groups.items() if name is not None),
+        key=lambda group: group.category.position,
+    )
+    return BuildPlan(roles=roles, groups=ordered_groups), errors
+
+def compile_bootstrap_payload(plan: BuildPlan, server_name: str) -> Dict[str, Any]:
+    """Compile a build plan into a create guild payload with placeholder IDs"""
+    # The first role always describes @everyone, whose placeholder ID is 0
+    roles = [{"id": 0}]
+    placeholders = {EVERYONE: 0}
+    # Discord stacks the payload's roles bottom up; the plan lists them top first
+    for role in reversed(plan.roles):
+        placeholders[role.name] = len(roles)
+        roles.append({
+            "id": len(roles),
+            "name": role.name,
+            "color": role.color,
+            "permissions": str(role.permissions),
+            "mentionable": role.mentionable,
+            "hoist": role.hoist,
+        })
+
+    def overwrites(permissions: Dict[str, Any]) -> List[Dict[str, Any]]:
+        payload = []
+        for target, value in permissions.items():
+            allow, deny = compile_overwrite(value)
+            payload.append({"id": placeholders[target], "type": 0, "allow": str(allow), "deny": str(deny)})
+        return payload
+
+    channels = []
+    next_id = len(roles)
+    for group in plan.groups:
+        parent_id = None
+        category_permissions = {}
+        if group.category:
+            parent_id = next_id
+            next_id += 1
+            category_permissions = group.category.permissions
+            channels.append({
+                "id": parent_id,
+                "name": group.category.name,
+                "type": CHANNEL_TYPES["category"],
+                "position": group.category.position or 0,
+                "permission_overwrites": overwrites(category_permissions),
+            })
+        for channel in group.channels:
+            channel_payload = {
+                "id": next_id,
+                "name": channel.name,
+                "type": CHANNEL_TYPES[channel.type],
+                "position": channel.position or 0,
+                # Spell out synced overwrites, the guild payload has no category sync
+                "permission_overwrites": overwrites(channel.permissions or category_permissions),
+            }
+            if parent_id is not None:
+                channel_payload["parent_id"] = parent_id
+            channels.append(channel_payload)
+            next_id += 1
+
+    return {"name": server_name, "roles": roles, "channels": channels}
+
+async def bootstrap_guild(plan: BuildPlan, server_name: str) -> discord.Guild:
+    """Create a guild together with its roles and channels in a single call"""
+    payload = compile_bootstrap_payload(plan, server_name)
+    data = await bot.http.request(discord.http.Route("POST", "/guilds"), json=payload)
+    return discord.Guild(data=data, state=bot._connection)
+
+async def wait_for_guild(guild: discord.Guild) -> discord.Guild:
+    """Wait until the gateway reports a newly created guild as available"""
+    if bot.shard_count and (guild.id >> 22) % bot.shard_count != bot.shard_id:
+        # Another shard's session receives this guild's GUILD_CREATE
+        return guild
+    waiter = asyncio.ensure_future(
+        bot.wait_for("guild_join", check=lambda joined: joined.id == guild.id, timeout=GUILD_AVAILABLE_TIMEOUT)
+    )
+    cached = bot.get_guild(guild.id)
+    if cached:
+        waiter.cancel()
+        return cached
+    try:
+        return await waiter
+    except asyncio.TimeoutError:
+        return guild
+
+# Build checkpoints
+class BuildCheckpoint:
+    """Discord objects created so far by one build, stored so a retry can resume it"""
+
+    def __init__(self, key: str, data: Dict[str, Any]):
+        self.key = key
+        self.status = data.get("status", "building")
+        self.guild_id: Optional[int] = data.get("guild_id")
+        self.bootstrapped = data.get("bootstrapped", False)
+        self.created: Dict[Tuple[str, str], int] = {
+            (item["kind"], item["name"]): item["id"] for item in data.get("created", [])
+        }
+        self.invite_link: Optional[str] = data.get("invite_link")
+        self.result: Optional[Dict[str, Any]] = data.get("result")
+
+    @classmethod
+    async def open(cls, key: str, template_id: str, server_name: str) -> "BuildCheckpoint":
+        """Load the checkpoint for key, creating an empty one for a new build"""
+        now = datetime.utcnow()
+        data = await db.server_builds.find_one_and_update(
+            {"idempotency_key": key},
+            {
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "idempotency_key": key,
+                    "template_id": template_id,
+                    "server_name": server_name,
+                    "status": "building",
+                    "created": [],
+                    "created_at": now,
+                },
+                "$set": {"updated_at": now},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return cls(key, data)
+
+    def get(self, kind: str, name: str) -> Optional[int]:
+        return self.created.get((kind, name))
+
+    async def _update(self, update: Dict[str, Any]):
+        update.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+        await db.server_builds.update_one({"idempotency_key": self.key}, update)
+
+    async def set_guild(self, guild_id: int, bootstrapped: bool):
+        # A new guild makes everything recorded for the old one irrelevant
+        self.guild_id = guild_id
+        self.bootstrapped = bootstrapped
+        self.created = {}
+        self.invite_link = None
+        await self._update({"$set": {
+            "guild_id": guild_id,
+            "bootstrapped": bootstrapped,
+            "created": [],
+            "invite_link": None,
+        }})
+
+    async def add(self, kind: str, name: str, discord_id: int):
+        self.created[(kind, name)] = discord_id
+        await self._update({"$push": {"created": {"kind": kind, "name": name, "id": discord_id}}})
+
+    async def finish(self, result: ServerCreationResponse, errors: List[str]):
+        self.status = "completed" if result.success else "failed"
+        self.result = result.dict()
+        await self._update({"$set": {"status": self.status, "result": self.result, "errors": errors}})
+
+async def resume_guild(checkpoint: BuildCheckpoint) -> Optional[discord.Guild]:
+    """Return the guild an earlier attempt created, if it still exists"""
+    if not checkpoint.guild_id:
+        return None
+    guild = bot.get_guild(checkpoint.guild_id)
+    if guild:
+        return guild
+    try:
+        return await bot.fetch_guild(checkpoint.guild_id)
+    except (discord.NotFound, discord.Forbidden):
+        logger.warning(f"Guild {checkpoint.guild_id} from build {checkpoint.key} is gone, starting over")
+        return None
+
+# Invites
+class InviteManager:
+    """Creates invites off the build's critical path and caches them per server"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._links: OrderedDict = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def cached(self, server_id: str) -> Optional[str]:
+        entry = self._links.get(server_id)
+        if entry and entry[0] > time.monotonic():
+            self._links.move_to_end(server_id)
+            return entry[1]
+        return None
+
+    def remember(self, server_id: str, invite_link: str):
+        self._links[server_id] = (time.monotonic() + self.ttl, invite_link)
+        self._links.move_to_end(server_id)
+        while len(self._links) > self.max_size:
+            self._links.popitem(last=False)
+
+    def schedule(self, server_id: str, channel_id: int, idempotency_key: Optional[str] = None):
+        """Create the invite in the background and store it once it exists"""
+        if server_id in self._pending:
+            return
+        task = asyncio.create_task(self._create(server_id, channel_id, idempotency_key))
+        self._pending[server_id] = task
+        task.add_done_callback(lambda _: self._pending.pop(server_id, None))
+
+    async def get(self, server_id: str, refresh: bool = False) -> Optional[str]:
+        """Return the server's invite, creating one if it has none or refresh is set"""
+        if not refresh:
+            invite_link = self.cached(server_id)
+            if invite_link:
+                return invite_link
+            if server_id in self._pending:
+                return await asyncio.shield(self._pending[server_id])
+            server_log = await db.created_servers.find_one({"server_id": server_id}, {"invite_link": 1})
+            if server_log and server_log.get("invite_link"):
+                self.remember(server_id, server_log["invite_link"])
+                return server_log["invite_link"]
+
+        channel_id = await self._invite_channel(int(server_id))
+        if channel_id is None:
+            return None
+        return await self._create(server_id, channel_id)
+
+    async def drain(self, timeout: float):
+        if self._pending:
+            await asyncio.wait(list(self._pending.values()), timeout=timeout)
+
+    async def _invite_channel(self, guild_id: int) -> Optional[int]:
+        guild = bot.get_guild(guild_id)
+        if guild:
+            channels = sorted(guild.text_channels, key=lambda channel: channel.position)
+            return channels[0].id if channels else None
+        channels = await discord_call(
+            "fetch_channels", guild_id, lambda: bot.http.get_all_guild_channels(guild_id), RetryBudget(DISCORD_RETRY_MAX_ATTEMPTS)
+        )
+        text_channels = sorted(
+            (channel for channel in channels if channel["type"] == CHANNEL_TYPES["text"]),
+            key=lambda channel: channel["position"],
+        )
+        return int(text_channels[0]["id"]) if text_channels else None
+
+    async def _create(self, server_id: str, channel_id: int, idempotency_key: Optional[str] = None) -> Optional[str]:
+        try:
+            invite = await discord_call(
+                "create_invite", int(server_id),
+                lambda: bot.http.create_invite(channel_id, max_age=0, max_uses=0),
+                RetryBudget(DISCORD_RETRY_MAX_ATTEMPTS),
+            )
+        except discord.HTTPException as e:
+            logger.warning(f"Error creating invite for server {server_id}: {e}")
+            return None
+        invite_link = f"https://discord.gg/{invite['code']}"
+        self.remember(server_id, invite_link)
+
+        try:
+            if idempotency_key:
+                await db.server_builds.update_one({"idempotency_key": idempotency_key}, {"$set": {"invite_link": invite_link}})
+            # The creation log may still be buffered, or not added until the build returns and reads the cache
+            if await created_server_logs.update({"server_id": server_id}, {"invite_link": invite_link}):
+                await response_cache.invalidate("servers")
+        except Exception as e:
+            logger.error(f"Error saving invite for server {server_id}: {e}")
+        return invite_link
+
+invites = InviteManager(INVITE_CACHE_SIZE, INVITE_CACHE_TTL)
+
+async def create_discord_server_internal(template: DiscordTemplate, server_name: str, progress: Optional[Callable[[str, Dict[str, Any]], None]] = None, plan: Optional[BuildPlan] = None, idempotency_key: Optional[str] = None) -> ServerCreationResponse:
+    """Internal function to create a Discord server
+
+    Every Discord object created is checkpointed under the idempotency key, so
+    calling this again with the same key continues an unfinished build.
+    """
+    def report(step: str, **detail):
+        if progress:
+            progress(step, detail)
+
+    idempotency_key = idempotency_key or str(uuid.uuid4())
+    try:
+        if not bot_ready:
+            return ServerCreationResponse(
+                success=False,
+                message="Discord bot is not ready. Please try again.",
+                idempotency_key=idempotency_key
+            )
+
+        checkpoint = await BuildCheckpoint.open(idempotency_key, template.id, server_name)
+        if checkpoint.status == "completed" and checkpoint.result:
+            result = ServerCreationResponse(**checkpoint.result)
+            invite_link = checkpoint.invite_link or invites.cached(result.server_id)
+            if invite_link:
+                result.invite_link = invite_link
+                result.invite_pending = False
+            return result
+
+        start = time.perf_counter()
+        result, errors = await build_guild(template, server_name, plan, checkpoint, report)
+        await checkpoint.finish(result, errors)
+        try:
+            await template_stats.record(template, result.success, time.perf_counter() - start)
+        except Exception as e:
+            logger.error(f"Error recording usage of template {template.id}: {e}")
+        return result
+
+    except Exception as e:
+        return ServerCreationResponse(
+            success=False,
+            message=f"Unexpected error: {str(e)}",
+            idempotency_key=idempotency_key
+        )
+
+async def build_guild(template: DiscordTemplate, server_name: str, plan: Optional[BuildPlan], checkpoint: BuildCheckpoint, report: Callable[..., None]) -> Tuple[ServerCreationResponse, List[str]]:
+    """Create whatever the checkpoint doesn't have yet and return the result with per-item errors"""
+    plan = plan or compile_template(template)[0]
+    errors = []
+    retry = RetryBudget(DISCORD_BUILD_RETRY_BUDGET)
+
+    def failed(message: str) -> Tuple[ServerCreationResponse, List[str]]:
+        return ServerCreationResponse(
+            success=False, message=message, idempotency_key=checkpoint.key, retried_steps=retry.retried_steps
+        ), errors
+
+    guild = await resume_guild(checkpoint)
+    if guild:
+        bootstrapped = checkpoint.bootstrapped
+    else:
+        bootstrapped = DISCORD_GUILD_BOOTSTRAP
+
+        # Create the guild (server)
+        try:
+            if bootstrapped:
+                guild = await discord_call("create_guild", None, lambda: bootstrap_guild(plan, server_name), retry, "guild")
+            else:
+                guild = await discord_call("create_guild", None, lambda: bot.create_guild(name=server_name), retry, "guild")
+        except discord.HTTPException as e:
+            if e.status == 403:
+                return failed("Bot doesn't have permission to create servers. Please check bot permissions.")
+            else:
+                return failed(f"Discord API error: {str(e)}")
+        except Exception as e:
+            return failed(f"Error creating guild: {str(e)}")
+        await checkpoint.set_guild(guild.id, bootstrapped)
+    
+    guild = await wait_for_guild(guild)
+    report("guild_created", server_id=str(guild.id))
+
+    text_channels = []
+    created_roles: Dict[str, discord.Role] = {}
+    roles_done = asyncio.Event()
+
+    def channel_overwrites(permissions: Dict[str, Any]) -> Dict[discord.Role, discord.PermissionOverwrite]:
+        """Resolve role names to this guild's roles; raises if one isn't there yet"""
+        resolved = {}
+        for target, value in permissions.items():
+            if target == EVERYONE:
+                role = guild.default_role
+            else:
+                role_id = checkpoint.get("role", target)
+                role = created_roles.get(target) or (guild.get_role(role_id) if role_id else None)
+            if role is None:
+                raise ValueError(f"role '{target}' was not created")
+            allow, deny = compile_overwrite(value)
+            resolved[role] = discord.PermissionOverwrite.from_pair(
+                discord.Permissions(allow), discord.Permissions(deny)
+            )
+        return resolved
+
+    # Lookups for create calls that failed in a way Discord may still have applied
+    async def find_role(name: str) -> Optional[discord.Role]:
+        async with discord_request("fetch_roles", guild.id):
+            roles = await bot.http.get_roles(guild.id)
+        data = next((role for role in roles if role["name"] == name), None)
+        return discord.Role(guild=guild, state=bot._connection, data=data) if data else None
+
+    async def find_channel(name: str, channel_type: str, parent: Optional[discord.abc.Snowflake]) -> Optional[discord.abc.GuildChannel]:
+        async with discord_request("fetch_channels", guild.id):
+            channels = await bot.http.get_all_guild_channels(guild.id)
+        parent_id = str(parent.id) if parent else None
+        data = next((
+            channel for channel in channels
+            if channel["name"] == name and channel["type"] == CHANNEL_TYPES[channel_type] and channel.get("parent_id") == parent_id
+        ), None)
+        if data is None:
+            return None
+        cls, _ = discord.channel._guild_channel_factory(data["type"])
+        return cls(state=bot._connection, guild=guild, data=data)
+
+    async def create_roles():
+        try:
+            await create_roles_in_order()
+        finally:
+            roles_done.set()
+
+    async def create_roles_in_order():
+        # Roles are created one after another so their hierarchy follows the template
+        for role_data in plan.roles:
+            if checkpoint.get("role", role_data.name):
+                continue
+            try:
+                role = await discord_call("create_role", guild.id, lambda: guild.create_role(
+                    name=role_data.name,
+                    color=discord.Color(role_data.color),
+                    permissions=discord.Permissions(permissions=role_data.permissions),
+                    mentionable=role_data.mentionable,
+                    hoist=role_data.hoist
+                ), retry, f"role:{role_data.name}", lookup=lambda: find_role(role_data.name))
+                created_roles[role_data.name] = role
+                await checkpoint.add("role", role_data.name, role.id)
+            except Exception as e:
+                errors.append(f"Role '{role_data.name}': {e}")
+                logger.warning(f"Error creating role {role_data.name} in guild {guild.id}: {e}")
+        report("roles_created", count=sum(1 for role_data in plan.roles if checkpoint.get("role", role_data.name)))
+
+    async def create_channel(channel_data: PlannedChannel, category: Optional[discord.abc.Snowflake], key: str):
+        existing = checkpoint.get("channel", key)
+        if existing:
+            channel = guild.get_channel(existing)
+            if isinstance(channel, discord.TextChannel):
+                text_channels.append(channel)
+            return
+        try:
+            # Overwrites ride on the create call; without any the channel syncs to its category
+            options = {"overwrites": channel_overwrites(channel_data.permissions)} if channel_data.permissions else {}
+            create = guild.create_text_channel if channel_data.type == "text" else guild.create_voice_channel
+            channel = await discord_call(f"create_{channel_data.type}_channel", guild.id, lambda: create(
+                name=channel_data.name,
+                category=category,
+                position=channel_data.position or 0,
+                **options
+            ), retry, f"channel:{key}", lookup=lambda: find_channel(channel_data.name, channel_data.type, category))
+            if channel_data.type == "text":
+                text_channels.append(channel)
+            await checkpoint.add("channel", key, channel.id)
+        except Exception as e:
+            errors.append(f"Channel '{key}': {e}")
+            logger.warning(f"Error creating channel {channel_data.name} in guild {guild.id}: {e}")
+
+    async def create_group(group: ChannelGroup):
+        category = None
+        prefix = ""
+        members = ([group.category] if group.category else []) + group.channels
+        if any(target != EVERYONE for channel_data in members for target in channel_data.permissions):
+            # Overwrites need the role IDs, other groups go ahead without waiting
+            await roles_done.wait()
+        if group.category:
+            prefix = group.category.name
+            existing = checkpoint.get("category", group.category.name)
+            if existing:
+                category = guild.get_channel(existing) or discord.Object(existing)
+            else:
+                try:
+                    options = {"overwrites": channel_overwrites(group.category.permissions)} if group.category.permissions else {}
+                    category = await discord_call("create_category", guild.id, lambda: guild.create_category(
+                        name=group.category.name,
+                        position=group.category.position or 0,
+                        **options
+                    ), retry, f"category:{group.category.name}", lookup=lambda: find_channel(group.category.name, "category", None))
+                    await checkpoint.add("category", group.category.name, category.id)
+                except Exception as e:
+                    errors.append(f"Category '{group.category.name}': {e}")
+                    logger.warning(f"Error creating category {group.category.name} in guild {guild.id}: {e}")
+                    # Leave the children for a retry rather than building them outside their category
+                    return
+        await asyncio.gather(*(
+            create_channel(channel_data, category, f"{prefix}/{channel_data.name}") for channel_data in group.channels
+        ))
+
+    async def create_channels():
+        # Categories are independent; each category's channels wait only on it
+        await asyncio.gather(*(create_group(group) for group in plan.groups))
+        report("channels_created", count=sum(1 for kind, _ in checkpoint.created if kind != "role"))
+
+    if bootstrapped:
+        # Roles and channels came with the guild; only fetch them if the gateway copy is missing
+        channels = guild.channels or await discord_call("fetch_channels", guild.id, guild.fetch_channels, retry, "fetch_channels")
+        text_channels = [c for c in channels if isinstance(c, discord.TextChannel)]
+        report("roles_created", count=len(plan.roles))
+        report("channels_created", count=len(channels))
+    else:
+        await asyncio.gather(create_roles(), create_channels())
+
+    # The invite is created in the background so the build returns as soon as the structure exists
+    invite_link = checkpoint.invite_link or invites.cached(str(guild.id))
+    invite_pending = False
+    if not invite_link:
+        # Prefer a channel from the template, falling back to the guild defaults
+        text_channels.sort(key=lambda c: c.position)
+        if not text_channels:
+            text_channels = [c for c in guild.channels if isinstance(c, discord.TextChannel)]
+        if text_channels:
+            invites.schedule(str(guild.id), text_channels[0].id, checkpoint.key)
+            invite_pending = True
+    report("invite_scheduled" if invite_pending else "invite_issued", invite_link=invite_link)
+
+    if errors:
+        return ServerCreationResponse(
+            success=False,
+            server_id=str(guild.id),
+            invite_link=invite_link,
+            invite_pending=invite_pending,
+            message=f"Server '{server_name}' was only partly created ({len(errors)} failed steps). Retry with the same idempotency key to finish it.",
+            idempotency_key=checkpoint.key,
+            retried_steps=retry.retried_steps
+        ), errors
+
+    return ServerCreationResponse(
+        success=True,
+        server_id=str(guild.id),
+        invite_link=invite_link,
+        invite_pending=invite_pending,
+        message=f"Server '{server_name}' created successfully!",
+        idempotency_key=checkpoint.key,
+        retried_steps=retry.retried_steps
+    ), errors
+
+async def create_discord_server(template: DiscordTemplate, server_name: str, progress: Optional[Callable[[str, Dict[str, Any]], None]] = None, timeout: float = SERVER_CREATION_TIMEOUT, plan: Optional[BuildPlan] = None, idempotency_key: Optional[str] = None) -> ServerCreationResponse:
+    """Dispatch server creation to the worker pool and wait for the result"""
+    return await server_creation_dispatcher.submit(template, server_name, progress, timeout, plan=plan, idempotency_key=idempotency_key)
+
+# Log writes
+class LogWriteBuffer:
+    """Write-behind buffer that sends log documents to one collection in batches
+
+    Documents are flushed in a single bulk write once batch_size are waiting,
+    flush_interval seconds after the first one was added, or at shutdown.
+    Documents given a key are upserted so a guild reported twice is logged
+    once. Jobs and build checkpoints never go through here.
+
+    Documents a bulk write fails on are put back and retried after a delay
+    that doubles with each failure, keeping at most max_pending waiting.
+    """
+
+    def __init__(self, collection: str, batch_size: int, flush_interval: float, max_pending: int, tag: Optional[str] = None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Response cache tag invalidated after each flush
+        self.tag = tag
+        # (document, key) pairs waiting to be written
+        self._documents: List[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        # Flushes failed in a row; while non-zero only the backoff timer flushes
+        self._failures = 0
+        # Documents dropped over max_pending since the last error was logged
+        self._dropped = 0
+
+    async def add(self, document: Dict[str, Any], key: Optional[Dict[str, Any]] = None):
+        self._documents.append((document, key))
+        self._trim()
+        if len(self._documents) >= self.batch_size and not self._failures:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(self.flush_interval))
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+            self._timer = None
+            documents, self._documents = self._documents, []
+            if not documents:
+                return
+            operations = [
+                UpdateOne(key, {"$setOnInsert": document}, upsert=True) if key else InsertOne(document)
+                for document, key in documents
+            ]
+            error = None
+            try:
+                await db[self.collection].bulk_write(operations, ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                # Unordered, so only the listed writes failed; a duplicate key fails again on retry
+                failed = [documents[write_error["index"]] for write_error in e.details.get("writeErrors", []) if write_error.get("code") != 11000]
+                error = e
+            except Exception as e:
+                failed, error = documents, e
+            if failed:
+                self._requeue(failed, error)
+            else:
+                self._failures = 0
+        if self.tag and len(failed) < len(documents):
+            await response_cache.invalidate(self.tag)
+
+    async def update(self, key: Dict[str, Any], fields: Dict[str, Any]) -> bool:
+        """Set fields on the document logged under key, written yet or not
+
+        Returns whether a written document was updated.
+        """
+        async with self._lock:
+            # No flush is running, so the document is either still buffered or written
+            for document, document_key in self._documents:
+                if document_key == key:
+                    document.update(fields)
+            result = await db[self.collection].update_one(key, {"$set": fields})
+        return bool(result.matched_count)
+
+    def _requeue(self, failed: List[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]], error: Exception):
+        """Put failed documents back ahead of newer ones and schedule a retry"""
+        self._failures += 1
+        self._documents = failed + self._documents
+        self._trim()
+        delay = min(self.flush_interval * 2 ** self._failures, LOG_WRITE_MAX_BACKOFF)
+        logger.error(
+            f"Error writing {len(failed)} {self.collection} logs, retrying in {delay:.1f}s"
+            + (f", dropped the {self._dropped} oldest" if self._dropped else "") + f": {error}"
+        )
+        self._dropped = 0
+        if self._timer:
+            self._timer.cancel()
+        self._timer = asyncio.create_task(self._flush_later(delay))
+
+    def _trim(self):
+        overflow = len(self._documents) - self.max_pending
+        if overflow > 0:
+            del self._documents[:overflow]
+            self._dropped += overflow
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self.flush()
+
+created_server_logs = LogWriteBuffer("created_servers", LOG_WRITE_BATCH_SIZE, LOG_WRITE_FLUSH_INTERVAL, LOG_WRITE_MAX_PENDING, tag="servers")
+status_check_logs = LogWriteBuffer("status_checks", LOG_WRITE_BATCH_SIZE, LOG_WRITE_FLUSH_INTERVAL, LOG_WRITE_MAX_PENDING)
+
+async def flush_logs():
+    """Write out every buffered log document"""
+    await asyncio.gather(created_server_logs.flush(), status_check_logs.flush())
+
+async def log_created_server(template_id: str, server_name: str, result: ServerCreationResponse):
+    """Save a server creation log for successful builds, once per guild"""
+    if result.success:
+        server_log = {
+            "id": str(uuid.uuid4()),
+            "template_id": template_id,
+            "server_name": server_name,
+            "server_id": result.server_id,
+            "invite_link": result.invite_link or invites.cached(result.server_id),
+            "created_at": datetime.utcnow(),
+            "success": True
+        }
+        # Resumed builds report the same guild again
+        await created_server_logs.add(server_log, key={"server_id": result.server_id})
+
+async def log_created_servers(template_id: str, results: List[Tuple[str, ServerCreationResponse]]):
+    """Save creation logs for the successful builds of a batch"""
+    for server_name, result in results:
+        await log_created_server(template_id, server_name, result)
+    await created_server_logs.flush()
+
+# Guild sync
+class GuildSync:
+    """Minimal set of changes that brings an existing guild in line with a build plan
+
+    Roles are matched by name, categories by name and channels by name and
+    type, preferring one in the same category. Reordering is collected into
+    one bulk position call for roles and one for channels.
+    """
+
+    # Roles before the channels whose overwrites use them, deletes last
+    ORDER = [
+        ("create", "role"), ("edit", "role"), ("move", "role"),
+        ("create", "category"), ("edit", "category"),
+        ("create", "channel"), ("edit", "channel"), ("move", "channel"),
+        ("delete", "channel"), ("delete", "category"), ("delete", "role"),
+    ]
+
+    def __init__(self, guild_id: int, plan: BuildPlan, roles: List[Dict[str, Any]], channels: List[Dict[str, Any]], delete_extra: bool = True):
+        self.guild_id = guild_id
+        self.plan = plan
+        self.operations: List[SyncOperation] = []
+        self.role_ids: Dict[str, int] = {EVERYONE: guild_id}
+        self.category_ids: Dict[str, int] = {}
+        # Member overwrites aren't part of templates and survive edits
+        self.member_overwrites: Dict[int, List[Dict[str, Any]]] = {}
+        self._diff_roles(roles, delete_extra)
+        self._diff_channels(channels, delete_extra)
+
+    def _diff_roles(self, roles: List[Dict[str, Any]], delete_extra: bool):
+        current = {}
+        extra = []
+        for role in sorted(roles, key=lambda role: (-role["position"], int(role["id"]))):
+            if int(role["id"]) == self.guild_id or role.get("managed"):
+                continue
+            if role["name"] in current:
+                extra.append(role)
+            else:
+                current[role["name"]] = role
+
+        planned = [role.name for role in self.plan.roles]
+        created = []
+        for role in self.plan.roles:
+            fields = {
+                "color": role.color,
+                "permissions": str(role.permissions),
+                "hoist": role.hoist,
+                "mentionable": role.mentionable,
+            }
+            existing = current.get(role.name)
+            if existing is None:
+                created.append(role.name)
+                self.operations.append(SyncOperation(action="create", kind="role", name=role.name, changes=fields))
+                continue
+            self.role_ids[role.name] = int(existing["id"])
+            changes = {field: value for field, value in fields.items() if existing.get(field) != value}
+            if changes:
+                self.operations.append(SyncOperation(action="edit", kind="role", name=role.name, id=existing["id"], changes=changes))
+
+        if delete_extra:
+            extra += [role for name, role in current.items() if name not in planned]
+            for role in extra:
+                self.operations.append(SyncOperation(action="delete", kind="role", name=role["name"], id=role["id"]))
+
+        # Kept roles stay in their current order, top first; new roles are created at the bottom, each one below the last
+        kept = [name for name in current if name in planned]
+        if kept + created != planned:
+            self.operations.append(SyncOperation(action="move", kind="role", name="positions", changes={"order": planned}))
+
+    def _diff_channels(self, channels: List[Dict[str, Any]], delete_extra: bool):
+        names_by_id = {role_id: name for name, role_id in self.role_ids.items()}
+        category_names = {
+            int(channel["id"]): channel["name"] for channel in channels if channel["type"] == CHANNEL_TYPES["category"]
+        }
+
+        def overwrites_of(channel: Dict[str, Any]) -> Dict[str, Any]:
+            return {
+                names_by_id.get(int(overwrite["id"]), overwrite["id"]): {"allow": int(overwrite["allow"]), "deny": int(overwrite["deny"])}
+                for overwrite in channel.get("permission_overwrites") or []
+                if overwrite["type"] == 0
+            }
+
+        candidates: Dict[Tuple[int, str], List[Dict[str, Any]]] = {}
+        for channel in sorted(channels, key=lambda channel: (channel["position"], int(channel["id"]))):
+            candidates.setdefault((channel["type"], channel["name"]), []).append(channel)
+
+        used = set()
+        # (parent, type) -> [(existing, move)] in plan order, to detect reordering
+        buckets: Dict[Tuple[Optional[str], int], List[Tuple[Dict[str, Any], Dict[str, Any]]]] = {}
+        moves = {}
+
+        def match(kind: str, planned: PlannedChannel, parent: Optional[str], overwrites: Dict[str, Any]):
+            channel_type = CHANNEL_TYPES[planned.type]
+            options = [channel for channel in candidates.get((channel_type, planned.name), []) if int(channel["id"]) not in used]
+            existing = next(
+                (channel for channel in options if category_names.get(int(channel.get("parent_id") or 0)) == parent),
+                options[0] if options else None,
+            )
+            if existing is None:
+                self.operations.append(SyncOperation(action="create", kind=kind, name=planned.name, changes={
+                    "type": planned.type,
+                    "position": planned.position,
+                    "parent": parent,
+                    "overwrites": overwrites,
+                }))
+                return
+
+            channel_id = int(existing["id"])
+            used.add(channel_id)
+            if kind == "category":
+                self.category_ids[planned.name] = channel_id
+            self.member_overwrites[channel_id] = [
+                overwrite for overwrite in existing.get("permission_overwrites") or [] if overwrite["type"] != 0
+            ]
+            if overwrites_of(existing) != overwrites:
+                self.operations.append(SyncOperation(action="edit", kind=kind, name=planned.name, id=existing["id"], changes={"overwrites": overwrites}))
+            move = {"id": existing["id"], "name": planned.name, "position": planned.position}
+            if kind == "channel":
+                move["parent"] = parent
+                if category_names.get(int(existing.get("parent_id") or 0)) != parent:
+                    moves[channel_id] = move
+            buckets.setdefault((parent, channel_type), []).append((existing, move))
+
+        for group in self.plan.groups:
+            parent = group.category.name if group.category else None
+            category_overwrites = {}
+            if group.category:
+                category_overwrites = dict(group.category.permissions)
+                match("category", group.category, None, category_overwrites)
+            for channel in group.channels:
+                # Channels without their own overwrites are synced to the category
+                match("channel", channel, parent, dict(channel.permissions) or category_overwrites)
+
+        # Discord normalizes positions, so only a change in relative order counts
+        for entries in buckets.values():
+            current_order = sorted(entries, key=lambda entry: (entry[0]["position"], int(entry[0]["id"])))
+            if [existing["id"] for existing, _ in current_order] != [existing["id"] for existing, _ in entries]:
+                moves.update((int(existing["id"]), move) for existing, move in entries)
+        if moves:
+            self.operations.append(SyncOperation(action="move", kind="channel", name="positions", changes={"channels": list(moves.values())}))
+
+        if delete_extra:
+            # Children first, so a category is only deleted once it is empty
+            for channel in sorted(channels, key=lambda channel: channel["type"] == CHANNEL_TYPES["category"]):
+                if int(channel["id"]) not in used:
+                    kind = "category" if channel["type"] == CHANNEL_TYPES["category"] else "channel"
+                    self.operations.append(SyncOperation(action="delete", kind=kind, name=channel["name"], id=channel["id"]))
+
+    def _overwrites(self, overwrites: Dict[str, Any]) -> List[Dict[str, Any]]:
+        payload = []
+        for target, value in overwrites.items():
+            if target not in self.role_ids:
+                raise ValueError(f"role '{target}' is not in the guild")
+            allow, deny = compile_overwrite(value)
+            payload.append({"id": self.role_ids[target], "type": 0, "allow": str(allow), "deny": str(deny)})
+        return payload
+
+    async def apply(self) -> List[str]:
+        """Execute the operations against Discord and return the ones that failed"""
+        errors = []
+        for operation in sorted(self.operations, key=lambda operation: self.ORDER.index((operation.action, operation.kind))):
+            try:
+                await self._apply(operation)
+            except Exception as e:
+                errors.append(f"{operation.action} {operation.kind} '{operation.name}': {e}")
+                logger.warning(f"Sync of guild {self.guild_id} could not {operation.action} {operation.kind} {operation.name}: {e}")
+        return errors
+
+    async def _apply(self, operation: SyncOperation):
+        guild_id = self.guild_id
+        changes = operation.changes
+        if operation.kind == "role":
+            if operation.action == "create":
+                async with discord_request("create_role", guild_id):
+                    data = await bot.http.create_role(guild_id, name=operation.name, **changes)
+                self.role_ids[operation.name] = int(data["id"])
+            elif operation.action == "edit":
+                async with discord_request("edit_role", guild_id):
+                    await bot.http.edit_role(guild_id, operation.id, **changes)
+            elif operation.action == "move":
+                order = [name for name in changes["order"] if name in self.role_ids]
+                positions = [{"id": self.role_ids[name], "position": len(order) - index} for index, name in enumerate(order)]
+                async with discord_request("move_roles", guild_id):
+                    await bot.http.move_role_position(guild_id, positions)
+            else:
+                async with discord_request("delete_role", guild_id):
+                    await bot.http.delete_role(guild_id, operation.id)
+            return
+
+        if operation.action == "create":
+            parent_id = None
+            if changes["parent"]:
+                parent_id = self.category_ids.get(changes["parent"])
+                if parent_id is None:
+                    raise ValueError(f"category '{changes['parent']}' was not created")
+            kind = "create_category" if operation.kind == "category" else f"create_{changes['type']}_channel"
+            async with discord_request(kind, guild_id):
+                data = await bot.http.create_channel(
+                    guild_id,
+                    CHANNEL_TYPES[changes["type"]],
+                    name=operation.name,
+                    position=changes["position"],
+                    parent_id=parent_id,
+                    permission_overwrites=self._overwrites(changes["overwrites"]),
+                )
+            if operation.kind == "category":
+                self.category_ids[operation.name] = int(data["id"])
+        elif operation.action == "edit":
+            overwrites = self._overwrites(changes["overwrites"]) + self.member_overwrites.get(int(operation.id), [])
+            async with discord_request("edit_channel", guild_id):
+                await bot.http.edit_channel(operation.id, permission_overwrites=overwrites)
+        elif operation.action == "move":
+            payload = []
+            for move in changes["channels"]:
+                update = {"id": move["id"], "position": move["position"]}
+                if "parent" in move:
+                    update["parent_id"] = self.category_ids.get(move["parent"]) if move["parent"] else None
+                payload.append(update)
+            async with discord_request("move_channels", guild_id):
+                await bot.http.bulk_channel_update(guild_id, payload)
+        else:
+            async with discord_request("delete_channel", guild_id):
+                await bot.http.delete_channel(operation.id)
+
+# Background server creation jobs
+class ServerCreationJobManager:
+    """Runs server creation jobs in the background and publishes their progress"""
+
+    def __init__(self):
+        self.jobs: Dict[str, ServerCreationJob] = {}
+        self.subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._write_locks: Dict[str, asyncio.Lock] = {}
+        self._tasks = set()
+
+    async def start(self, template: DiscordTemplate, server_name: str, plan: Optional[BuildPlan] = None, idempotency_key: Optional[str] = None) -> ServerCreationJob:
+        job = ServerCreationJob(template_id=template.id, server_name=server_name, idempotency_key=idempotency_key)
+        await db.server_creation_jobs.insert_one(job.dict())
+        self.jobs[job.id] = job
+        self._write_locks[job.id] = asyncio.Lock()
+
+        task = asyncio.create_task(self._run(template, job, plan))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def drain(self, timeout: float):
+        """Give running jobs time to record their results and log their servers"""
+        if self._tasks:
+            _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+            if pending:
+                logger.warning(f"Shutting down with {len(self.jobs)} server creation jobs unfinished")
+
+    async def get(self, job_id: str) -> Optional[ServerCreationJob]:
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        job_data = await db.server_creation_jobs.find_one({"id": job_id})
+        return ServerCreationJob(**job_data) if job_data else None
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        updates = asyncio.Queue()
+        self.subscribers.setdefault(job_id, []).append(updates)
+        return updates
+
+    def unsubscribe(self, job_id: str, updates: asyncio.Queue):
+        subscribers = self.subscribers.get(job_id, [])
+        if updates in subscribers:
+            subscribers.remove(updates)
+        if not subscribers:
+            self.subscribers.pop(job_id, None)
+
+    async def _run(self, template: DiscordTemplate, job: ServerCreationJob, plan: Optional[BuildPlan]):
+        def progress(step: str, detail: Dict[str, Any]):
+            self._record(job, step, detail)
+
+        try:
+            result = await create_discord_server(template, job.server_name, progress, SERVER_CREATION_JOB_TIMEOUT, plan=plan, idempotency_key=job.idempotency_key or job.id)
+        except Exception as e:
+            result = ServerCreationResponse(
+                success=False,
+                message=f"Error creating server: {str(e)}"
+            )
+
+        job.status = "completed" if result.success else "failed"
+        job.result = result
+        job.updated_at = datetime.utcnow()
+        self._publish(job)
+        try:
+            await self._persist(job)
+            await log_created_server(job.template_id, job.server_name, result)
+        except Exception as e:
+            logger.error(f"Error saving server creation job {job.id}: {e}")
+        finally:
+            self.jobs.pop(job.id, None)
+            self._write_locks.pop(job.id, None)
+
+    def _record(self, job: ServerCreationJob, step: str, detail: Dict[str, Any]):
+        job.status = "running"
+        job.updated_at = datetime.utcnow()
+        job.steps.append({"step": step, "at": job.updated_at, **detail})
+        self._publish(job)
+
+        task = asyncio.create_task(self._persist(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _publish(self, job: ServerCreationJob):
+        for updates in self.subscribers.get(job.id, []):
+            updates.put_nowait(job.copy(deep=True))
+
+    async def _persist(self, job: ServerCreationJob):
+        # Writes are serialized per job and always store the latest state
+        lock = self._write_locks.get(job.id)
+        if lock is None:
+            return
+        async with lock:
+            await db.server_creation_jobs.update_one(
+                {"id": job.id},
+                {"$set": job.dict(exclude={"id"})}
+            )
+
+server_creation_jobs = ServerCreationJobManager()
+
+# Template cache
+class TemplateCache:
+    """LRU cache of parsed templates and their build plans with a TTL"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._object_ids: Dict[Any, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+    async def get(self, template_id: str) -> Optional[Tuple[DiscordTemplate, BuildPlan]]:
+        """Get a parsed template and its build plan, loading it on a miss"""
+        entry = self._entries.get(template_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(template_id)
+            self.hits += 1
+            return entry[2], entry[3]
+
+        self.misses += 1
+        template_data = await db.discord_templates.find_one({"id": template_id})
+        if not template_data:
+            return None
+
+        template_data = expand_template_document(template_data)
+        template = DiscordTemplate(**template_data)
+        if template_data.get("build_plan"):
+            plan = BuildPlan(**template_data["build_plan"])
+        else:
+            # Templates stored before compilation existed get compiled once here
+            plan, errors = compile_template(template)
+            if errors:
+                logger.warning(f"Template {template_id} has errors, skipping: {'; '.join(errors)}")
+        self.put(template_data.get("_id"), template, plan)
+        return template, plan
+
+    def put(self, object_id: Any, template: DiscordTemplate, plan: BuildPlan):
+        self.invalidate(template.id, count=False)
+        self._entries[template.id] = (time.monotonic() + self.ttl, object_id, template, plan)
+        if object_id is not None:
+            self._object_ids[object_id] = template.id
+        while len(self._entries) > self.max_size:
+            _, (_, evicted_object_id, _, _) = self._entries.popitem(last=False)
+            self._object_ids.pop(evicted_object_id, None)
+
+    def invalidate(self, template_id: str, count: bool = True):
+        entry = self._entries.pop(template_id, None)
+        if entry:
+            self._object_ids.pop(entry[1], None)
+            if count:
+                self.invalidations += 1
+
+    async def watch(self):
+        """Follow a Mongo change stream so caches on other replicas stay coherent"""
+        while True:
+            try:
+                async with db.discord_templates.watch() as stream:
+                    async for change in stream:
+                        template_id = (change.get("fullDocument") or {}).get("id")
+                        if template_id is None:
+                            # Deletes and partial updates only carry the Mongo _id
+                            template_id = self._object_ids.get(change["documentKey"]["_id"])
+                        if template_id is not None:
+                            self.invalidate(template_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Template cache change stream failed: {e}")
+                # Anything may have changed while the stream was down
+                self._entries.clear()
+                self._object_ids.clear()
+                await asyncio.sleep(5)
+
+template_cache = TemplateCache(TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL)
+
+# Template usage
+class TemplateStats:
+    """Per-template build counters kept in template_stats and mirrored in memory
+
+    Builds increment the stored counters atomically. The in-memory copy is
+    loaded once and then refreshed with only the documents changed since the
+    last refresh, so counters from other replicas and workers show up too.
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._synced_at: Optional[datetime] = None
+        self._refreshed = 0.0
+        self._lock = asyncio.Lock()
+
+    async def record(self, template: DiscordTemplate, success: bool, duration: float):
+        now = datetime.utcnow()
+        doc = await db.template_stats.find_one_and_update(
+            {"id": template.id},
+            {
+                "$inc": {"uses": 1, "failures": 0 if success else 1, "build_seconds": duration},
+                "$set": {"name": template.name, "last_used_at": now, "updated_at": now},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._stats[template.id] = doc
+
+    async def remove(self, template_id: str):
+        self._stats.pop(template_id, None)
+        await db.template_stats.delete_one({"id": template_id})
+
+    async def refresh(self, force: bool = False):
+        """Pull counters changed since the last refresh"""
+        if not force and time.monotonic() - self._refreshed < self.refresh_interval:
+            return
+        async with self._lock:
+            query = {"updated_at": {"$gte": self._synced_at}} if self._synced_at else {}
+            synced_at = datetime.utcnow()
+            async for doc in db.template_stats.find(query):
+                self._stats[doc["id"]] = doc
+            self._synced_at = synced_at
+            self._refreshed = time.monotonic()
+
+    def popular(self, limit: int) -> List[str]:
+        ranked = sorted(self._stats.values(), key=lambda doc: (doc["uses"], doc["last_used_at"]), reverse=True)
+        return [doc["id"] for doc in ranked[:limit]]
+
+    def summaries(self) -> List[TemplateStatsSummary]:
+        return [
+            TemplateStatsSummary(
+                template_id=doc["id"],
+                name=doc.get("name"),
+                uses=doc["uses"],
+                failures=doc["failures"],
+                avg_build_seconds=doc["build_seconds"] / doc["uses"],
+                last_used_at=doc["last_used_at"],
+            )
+            for doc in sorted(self._stats.values(), key=lambda doc: (doc["uses"], doc["last_used_at"]), reverse=True)
+        ]
+
+template_stats = TemplateStats(TEMPLATE_STATS_REFRESH_INTERVAL)
+
+async def prewarm_template_cache():
+    """Load the most-used templates into the cache before the first request asks for them"""
+    await template_stats.refresh(force=True)
+    for template_id in template_stats.popular(min(TEMPLATE_CACHE_PREWARM, TEMPLATE_CACHE_SIZE)):
+        await template_cache.get(template_id)
+
+# Durable job queue
+class MongoJobQueue:
+    """Server creation jobs in Mongo, claimed by workers under an expiring lease"""
+
+    def __init__(self, lease_seconds: int, max_attempts: int, poll_interval: float):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+    async def enqueue(self, template_id: str, server_name: str, idempotency_key: Optional[str] = None) -> ServerCreationJob:
+        """Queue a job, or return the queued or running one with the same idempotency key"""
+        job = ServerCreationJob(template_id=template_id, server_name=server_name, idempotency_key=idempotency_key)
+        job_data = job.dict()
+        if not idempotency_key:
+            await db.server_creation_jobs.insert_one(job_data)
+            return job
+        # Unique while the job is active, so two workers never build the same checkpoint at once
+        job_data["active_key"] = idempotency_key
+        while True:
+            try:
+                await db.server_creation_jobs.insert_one(dict(job_data))
+                return job
+            except DuplicateKeyError:
+                existing = await db.server_creation_jobs.find_one({"active_key": idempotency_key})
+                if existing:
+                    return ServerCreationJob(**existing)
+
+    async def wait(self, job_id: str, timeout: float) -> ServerCreationResponse:
+        """Poll a job until a worker finishes it or the timeout passes"""
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while time.monotonic() < deadline:
+            job_data = await db.server_creation_jobs.find_one({"id": job_id}, {"status": 1, "result": 1, "idempotency_key": 1})
+            if job_data and job_data.get("result") and job_data["status"] in ("completed", "failed"):
+                return ServerCreationResponse(**job_data["result"])
+            await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 1.0)
+        return ServerCreationResponse(
+            success=False,
+            message="Server creation is still running. Retry with the same idempotency key to get its result.",
+            idempotency_key=job_data.get("idempotency_key") if job_data else None
+        )
+
+    async def claim(self, worker_id: str) -> Optional[ServerCreationJob]:
+        """Atomically take the oldest queued job or one whose lease has expired"""
+        now = datetime.utcnow()
+        job_data = await db.server_creation_jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued"},
+                    {"status": "running", "lease_expires_at": {"$lt": now}},
+                ],
+                "attempts": {"$lt": self.max_attempts},
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_owner": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return ServerCreationJob(**job_data) if job_data else None
+
+    async def renew(self, job_id: str, worker_id: str) -> bool:
+        result = await db.server_creation_jobs.update_one(
+            {"id": job_id, "lease_owner": worker_id},
+            {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.modified_count > 0
+
+    async def save_steps(self, job: ServerCreationJob, worker_id: str):
+        await db.server_creation_jobs.update_one(
+            {"id": job.id, "lease_owner": worker_id},
+            {"$set": {"status": "running", "steps": job.steps, "updated_at": datetime.utcnow()}}
+        )
+
+    async def finish(self, job: ServerCreationJob, worker_id: str, result: ServerCreationResponse) -> bool:
+        """Store the result unless the lease was lost to another worker"""
+        update = await db.server_creation_jobs.update_one(
+            {"id": job.id, "lease_owner": worker_id},
+            {
+                "$set": {
+                    "status": "completed" if result.success else "failed",
+                    "result": result.dict(),
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                    "updated_at": datetime.utcnow(),
+                },
+                "$unset": {"active_key": ""},
+            }
+        )
+        return update.modified_count > 0
+
+    async def fail_exhausted(self):
+        """Fail jobs whose lease expired after their last allowed attempt"""
+        result = ServerCreationResponse(
+            success=False,
+            message="Server creation failed after too many attempts."
+        )
+        await db.server_creation_jobs.update_many(
+            {
+                "status": "running",
+                "lease_expires_at": {"$lt": datetime.utcnow()},
+                "attempts": {"$gte": self.max_attempts},
+            },
+            {
+                "$set": {
+                    "status": "failed",
+                    "result": result.dict(),
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                    "updated_at": datetime.utcnow(),
+                },
+                "$unset": {"active_key": ""},
+            }
+        )
+
+    async def process(self, job: ServerCreationJob, worker_id: str):
+        """Build a claimed job through the local dispatcher while renewing its lease"""
+        async def keep_lease():
+            while True:
+                await asyncio.sleep(self.lease_seconds / 3)
+                if not await self.renew(job.id, worker_id):
+                    logger.warning(f"Worker {worker_id} lost the lease on job {job.id}")
+                    return
+
+        write_lock = asyncio.Lock()
+        writes = set()
+
+        async def save_steps():
+            async with write_lock:
+                await self.save_steps(job, worker_id)
+
+        def progress(step: str, detail: Dict[str, Any]):
+            job.steps.append({"step": step, "at": datetime.utcnow(), **detail})
+            task = asyncio.get_running_loop().create_task(save_steps())
+            writes.add(task)
+            task.add_done_callback(writes.discard)
+
+        lease = asyncio.create_task(keep_lease())
+        try:
+            cached = await template_cache.get(job.template_id)
+            if not cached:
+                result = ServerCreationResponse(success=False, message="Template not found")
+            else:
+                template, plan = cached
+                result = await create_discord_server(template, job.server_name, progress, SERVER_CREATION_JOB_TIMEOUT, plan=plan, idempotency_key=job.idempotency_key or job.id)
+        except Exception as e:
+            result = ServerCreationResponse(
+                success=False,
+                message=f"Error creating server: {str(e)}"
+            )
+        finally:
+            lease.cancel()
+
+        if writes:
+            await asyncio.gather(*writes, return_exceptions=True)
+        if await self.finish(job, worker_id, result):
+            await log_created_server(job.template_id, job.server_name, result)
+
+    async def run_worker(self, worker_id: str, concurrency: int, stopping: asyncio.Event):
+        """Claim and build jobs with up to `concurrency` in flight until stopping is set"""
+        slots = asyncio.Semaphore(concurrency)
+        in_flight = set()
+        idle_delay = 0.1
+        while not stopping.is_set():
+            await slots.acquire()
+            # Leave jobs queued while Discord's global limit is in effect
+            await discord_circuit.wait()
+            try:
+                await self.fail_exhausted()
+                job = await self.claim(worker_id)
+            except Exception as e:
+                logger.error(f"Worker {worker_id} could not claim a job: {e}")
+                job = None
+            if job is None:
+                slots.release()
+                # Back off while the queue is empty so idle workers stay quiet
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopping.wait(), idle_delay)
+                idle_delay = min(idle_delay * 2, self.poll_interval)
+                continue
+
+            idle_delay = 0.1
+            logger.info(f"Worker {worker_id} claimed job {job.id} (attempt {job.attempts})")
+            task = asyncio.create_task(self.process(job, worker_id))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            task.add_done_callback(lambda _: slots.release())
 
-# Discord Bot setup
-intents = discord.Intents.default()
-intents.guilds = True
-intents.guild_messages = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+        # Drain builds that were already claimed
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
 
-# Global variables for bot status
-bot_ready = False
-bot_user = None
+job_queue = MongoJobQueue(JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL)
 
-# Queue for handling server creation requests
-server_creation_queue = queue.Queue()
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
 
-# Create the main app without a prefix
-app = FastAPI()
+# Keyset pagination
+def encode_cursor(sort_value: Union[datetime, int], item_id: str) -> str:
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, item_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+def decode_cursor(cursor: str) -> Tuple[Union[datetime, int], str]:
+    try:
+        sort_value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(sort_value, str):
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, str(item_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-# Pydantic Models
-class StatusCheck(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    client_name: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+async def paginate(collection, sort_field: str, limit: int, cursor: Optional[str], response: Response, projection: Optional[Dict[str, int]] = None) -> List[Dict[str, Any]]:
+    """Fetch one page newest first and set X-Next-Cursor when more remain"""
+    query = {}
+    if cursor:
+        sort_value, item_id = decode_cursor(cursor)
+        query = {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": item_id}},
+        ]}
 
-class StatusCheckCreate(BaseModel):
-    client_name: str
+    documents = await collection.find(query, projection).sort(
+        [(sort_field, -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
 
-class DiscordChannel(BaseModel):
-    name: str
-    type: str  # "text", "voice", "category"
-    category: Optional[str] = None
-    position: Optional[int] = 0
-    permissions: Optional[Dict[str, Any]] = {}
+    if len(documents) > limit:
+        documents = documents[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(documents[-1][sort_field], documents[-1]["id"])
+    return documents
 
-class DiscordRole(BaseModel):
-    name: str
-    color: Optional[str] = "#000000"
-    permissions: Optional[int] = 0
-    mentionable: Optional[bool] = True
-    hoist: Optional[bool] = False
+# Template uploads
+TEMPLATE_CONTENT_FIELDS = {"name", "description", "icon_url", "channels", "roles"}
+# Fields moved into the compressed payload of large templates
+TEMPLATE_PAYLOAD_FIELDS = ("channels", "roles", "build_plan")
 
-class DiscordTemplate(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    name: str
-    description: Optional[str] = ""
-    icon_url: Optional[str] = None
-    channels: List[DiscordChannel]
-    roles: List[DiscordRole]
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    created_by: Optional[str] = None
+def template_content_hash(template: DiscordTemplate) -> str:
+    """Hash a template's content, ignoring its id and upload metadata"""
+    content = json.dumps(template.dict(include=TEMPLATE_CONTENT_FIELDS), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(content.encode()).hexdigest()
 
-class ServerCreationRequest(BaseModel):
-    template_id: str
-    server_name: str
+def template_document(template: DiscordTemplate, plan: BuildPlan) -> Dict[str, Any]:
+    """Build the stored document for a template with its compiled plan"""
+    template_dict = template.dict()
+    template_dict["content_hash"] = template.content_hash or template_content_hash(template)
+    template_dict["build_plan"] = plan.dict()
 
-class ServerCreationResponse(BaseModel):
-    success: bool
-    server_id: Optional[str] = None
-    invite_link: Optional[str] = None
-    message: str
+    if TEMPLATE_COMPRESS_MIN_BYTES:
+        payload = json.dumps({field: template_dict[field] for field in TEMPLATE_PAYLOAD_FIELDS}, separators=(",", ":"))
+        if len(payload) >= TEMPLATE_COMPRESS_MIN_BYTES:
+            for field in TEMPLATE_PAYLOAD_FIELDS:
+                del template_dict[field]
+            template_dict["payload"] = zlib.compress(payload.encode())
+    return template_dict
 
-# Discord Bot Events
-@bot.event
-async def on_ready():
-    global bot_ready, bot_user
-    bot_ready = True
-    bot_user = bot.user
-    print(f'{bot.user} has logged in to Discord!')
-    
-    # Start the server creation worker
-    asyncio.create_task(server_creation_worker())
+def expand_template_document(template_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Restore the fields of a template stored with a compressed payload"""
+    payload = template_data.pop("payload", None)
+    if payload is not None:
+        template_data.update(json.loads(zlib.decompress(payload)))
+    return template_data
 
-# Server creation worker
-async def server_creation_worker():
-    """Worker to handle server creation requests from queue"""
-    while True:
-        try:
-            if not server_creation_queue.empty():
-                request_data = server_creation_queue.get()
-                template = request_data['template']
-                server_name = request_data['server_name']
-                result_queue = request_data['result_queue']
-                
-                try:
-                    result = await create_discord_server_internal(template, server_name)
-                    result_queue.put(result)
-                except Exception as e:
-                    error_result = ServerCreationResponse(
-                        success=False,
-                        message=f"Worker error: {str(e)}"
-                    )
-                    result_queue.put(error_result)
-                    
-            await asyncio.sleep(0.1)  # Small delay to prevent busy waiting
-        except Exception as e:
-            print(f"Error in server creation worker: {e}")
-            await asyncio.sleep(1)
+async def store_templates(items: List[Tuple[DiscordTemplate, BuildPlan]]) -> List[Tuple[str, bool]]:
+    """Save templates, skipping any whose content is already stored
 
-# Discord Bot Functions
-async def create_discord_server_internal(template: DiscordTemplate, server_name: str) -> ServerCreationResponse:
-    """Internal function to create a Discord server"""
-    try:
-        if not bot_ready:
-            return ServerCreationResponse(
-                success=False,
-                message="Discord bot is not ready. Please try again."
-            )
+    Returns the stored id for each item and whether it was a duplicate. New
+    templates get the next version number for their name.
+    """
+    for template, _ in items:
+        template.content_hash = template_content_hash(template)
+    existing = {
+        doc["content_hash"]: doc["id"]
+        async for doc in db.discord_templates.find(
+            {"content_hash": {"$in": [template.content_hash for template, _ in items]}}, {"content_hash": 1, "id": 1}
+        )
+    }
+    versions = {
+        doc["_id"]: doc["version"]
+        async for doc in db.discord_templates.aggregate([
+            {"$match": {"name": {"$in": list({template.name for template, _ in items})}}},
+            {"$group": {"_id": "$name", "version": {"$max": {"$ifNull": ["$version", 1]}}}},
+        ])
+    }
 
-        # Create the guild (server)
+    results = []
+    documents = []
+    for template, plan in items:
+        if template.content_hash in existing:
+            results.append((existing[template.content_hash], True))
+            continue
+        template.version = versions.get(template.name, 0) + 1
+        versions[template.name] = template.version
+        existing[template.content_hash] = template.id
+        documents.append(template_document(template, plan))
+        results.append((template.id, False))
+
+    if documents:
         try:
-            guild = await bot.create_guild(name=server_name)
-        except discord.HTTPException as e:
-            if e.status == 403:
-                return ServerCreationResponse(
-                    success=False,
-                    message="Bot doesn't have permission to create servers. Please check bot permissions."
-                )
-            else:
-                return ServerCreationResponse(
-                    success=False,
-                    message=f"Discord API error: {str(e)}"
-                )
-        except Exception as e:
-            return ServerCreationResponse(
-                success=False,
-                message=f"Error creating guild: {str(e)}"
-            )
-        
-        # Wait a moment for the guild to be fully created
-        await asyncio.sleep(2)
-        
-        # Create roles first
-        created_roles = {}
-        for role_data in template.roles:
-            if role_data.name.lower() != "@everyone":  # Skip @everyone role
-                try:
-                    color_value = int(role_data.color.replace("#", ""), 16) if role_data.color else 0
-                    role = await guild.create_role(
-                        name=role_data.name,
-                        color=discord.Color(color_value),
-                        permissions=discord.Permissions(permissions=role_data.permissions or 0),
-                        mentionable=role_data.mentionable,
-                        hoist=role_data.hoist
-                    )
-                    created_roles[role_data.name] = role
-                except Exception as e:
-                    print(f"Error creating role {role_data.name}: {e}")
+            await db.discord_templates.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            # Lost a race with an identical upload, point at the stored copy instead
+            hashes = [document["content_hash"] for document in documents]
+            stored = {
+                doc["content_hash"]: doc["id"]
+                async for doc in db.discord_templates.find({"content_hash": {"$in": hashes}}, {"content_hash": 1, "id": 1})
+            }
+            results = [
+                (stored.get(template.content_hash, template_id), duplicate or stored.get(template.content_hash) != template_id)
+                for (template, _), (template_id, duplicate) in zip(items, results)
+            ]
+    return results
 
-        # Create categories and channels
-        created_categories = {}
-        
-        for channel_data in template.channels:
-            try:
-                if channel_data.type == "category":
-                    category = await guild.create_category(
-                        name=channel_data.name,
-                        position=channel_data.position or 0
-                    )
-                    created_categories[channel_data.name] = category
-                    
-                elif channel_data.type == "text":
-                    category = created_categories.get(channel_data.category)
-                    await guild.create_text_channel(
-                        name=channel_data.name,
-                        category=category,
-                        position=channel_data.position or 0
-                    )
-                    
-                elif channel_data.type == "voice":
-                    category = created_categories.get(channel_data.category)
-                    await guild.create_voice_channel(
-                        name=channel_data.name,
-                        category=category,
-                        position=channel_data.position or 0
-                    )
-            except Exception as e:
-                print(f"Error creating channel {channel_data.name}: {e}")
+def encoded_response(request: Request, content: Any, response: Optional[Response] = None) -> Response:
+    """Serialize a response body with an ETag, as JSON or msgpack, gzipped when accepted
 
-        # Create an invite link
-        try:
-            # Get the first text channel to create invite
-            text_channels = [c for c in guild.channels if isinstance(c, discord.TextChannel)]
-            if text_channels:
-                invite = await text_channels[0].create_invite(max_age=0, max_uses=0)
-                invite_link = invite.url
-            else:
-                invite_link = None
-        except:
-            invite_link = None
+    Returns 304 Not Modified when If-None-Match already names this body.
+    """
+    data = jsonable_encoder(content)
+    if msgpack is not None and "application/msgpack" in request.headers.get("accept", ""):
+        body, media_type = msgpack.packb(data), "application/msgpack"
+    else:
+        body, media_type = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode(), "application/json"
 
-        return ServerCreationResponse(
-            success=True,
-            server_id=str(guild.id),
-            invite_link=invite_link,
-            message=f"Server '{server_name}' created successfully!"
-        )
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if response is not None and "X-Next-Cursor" in response.headers:
+        headers["X-Next-Cursor"] = response.headers["X-Next-Cursor"]
 
-    except Exception as e:
-        return ServerCreationResponse(
-            success=False,
-            message=f"Unexpected error: {str(e)}"
-        )
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    gzipped = len(body) >= RESPONSE_GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", "")
+    # Each representation gets its own strong ETag
+    headers["ETag"] = f'"{digest}-gzip"' if gzipped else f'"{digest}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or any(
+        tag.strip().removeprefix("W/").strip('"').removesuffix("-gzip") == digest for tag in if_none_match.split(",")
+    ):
+        return Response(status_code=304, headers=headers)
 
-async def create_discord_server(template: DiscordTemplate, server_name: str) -> ServerCreationResponse:
-    """Queue-based server creation function"""
-    result_queue = queue.Queue()
-    
-    # Add request to queue
-    server_creation_queue.put({
-        'template': template,
-        'server_name': server_name,
-        'result_queue': result_queue
-    })
-    
-    # Wait for result (with timeout)
-    timeout = 60  # 60 seconds timeout
-    start_time = asyncio.get_event_loop().time()
-    
+    if gzipped:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type=media_type, headers=headers)
+
+def parse_template(text: str) -> Tuple[DiscordTemplate, BuildPlan]:
+    """Parse and compile one template document"""
+    template = DiscordTemplate(**json.loads(text))
+    plan, errors = compile_template(template)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return template, plan
+
+async def read_upload(file: UploadFile, max_bytes: int) -> str:
+    """Read an upload in chunks, rejecting it as soon as it exceeds max_bytes"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parts = []
+    size = 0
     while True:
-        if not result_queue.empty():
-            return result_queue.get()
-            
-        current_time = asyncio.get_event_loop().time()
-        if current_time - start_time > timeout:
-            return ServerCreationResponse(
-                success=False,
-                message="Server creation timed out. Please try again."
-            )
-            
-        await asyncio.sleep(0.1)
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Template exceeds the {max_bytes} byte limit")
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+async def iter_ndjson_templates(request: Request):
+    """Yield (line number, document bytes) pairs from an NDJSON body as it streams in
+
+    Lines over TEMPLATE_UPLOAD_MAX_BYTES are skipped up to their newline and
+    yielded with None, like oversized zip entries.
+    """
+    # Split on raw bytes; a newline byte never occurs inside a multi-byte UTF-8 sequence
+    line = bytearray()
+    oversized = False
+    size = 0
+    line_number = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > TEMPLATE_BULK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds the {TEMPLATE_BULK_MAX_BYTES} byte limit")
+        # Only the new chunk is searched, so a long line costs linear time
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if not oversized:
+                line += chunk[start:] if end == -1 else chunk[start:end]
+                if len(line) > TEMPLATE_UPLOAD_MAX_BYTES:
+                    oversized = True
+                    line.clear()
+            if end == -1:
+                break
+            line_number += 1
+            if oversized:
+                yield f"line {line_number}", None
+            elif line.strip():
+                yield f"line {line_number}", bytes(line)
+            line.clear()
+            oversized = False
+            start = end + 1
+    if oversized:
+        yield f"line {line_number + 1}", None
+    elif line.strip():
+        yield f"line {line_number + 1}", bytes(line)
+
+async def iter_zip_templates(request: Request):
+    """Yield (file name, document bytes) pairs for the JSON files in a zip body"""
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_CHUNK_SIZE * 16) as spool:
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > TEMPLATE_BULK_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds the {TEMPLATE_BULK_MAX_BYTES} byte limit")
+            spool.write(chunk)
+        spool.seek(0)
+
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="Invalid zip file")
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.endswith('.json'):
+                    continue
+                if info.file_size > TEMPLATE_UPLOAD_MAX_BYTES:
+                    yield info.filename, None
+                    continue
+                yield info.filename, archive.read(info)
+
+async def ensure_indexes():
+    """Create the indexes behind lookups by id and the paginated listings"""
+    await db.discord_templates.create_index("id")
+    await db.discord_templates.create_index([("created_at", -1), ("id", -1)])
+    await db.discord_templates.create_index("content_hash", unique=True, sparse=True)
+    await db.discord_templates.create_index([("name", 1), ("version", -1)])
+    await db.status_checks.create_index([("timestamp", -1), ("id", -1)])
+    await db.status_checks.create_index([("client_name", 1), ("timestamp", -1)])
+    try:
+        await db.status_checks.create_index("timestamp", expireAfterSeconds=STATUS_CHECK_TTL)
+    except OperationFailure:
+        # The TTL index already exists with another expiry
+        await db.command("collMod", "status_checks", index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": STATUS_CHECK_TTL})
+    await db.created_servers.create_index([("created_at", -1), ("id", -1)])
+    await db.server_creation_jobs.create_index("id")
+    await db.server_creation_jobs.create_index([("status", 1), ("created_at", 1)])
+    await db.server_creation_jobs.create_index("active_key", unique=True, sparse=True)
+    await db.server_builds.create_index("idempotency_key", unique=True)
+    await db.created_servers.create_index("server_id")
+    await db.template_stats.create_index("id", unique=True)
+    await db.template_stats.create_index([("uses", -1), ("id", -1)])
+    await db.template_stats.create_index([("last_used_at", -1), ("id", -1)])
+    await db.template_stats.create_index("updated_at")
 
 # API Routes
 @api_router.get("/")
 async def root():
-    return {"message": "Discord Server Creator API", "bot_ready": bot_ready, "bot_user": str(bot_user) if bot_user else None}
+    # Reports the gateway connection, which the frontend shows; builds are admitted on bot_ready_event
+    bot_connected = bot_connected_event.is_set() and not bot.is_closed()
+    return {"message": "Discord Server Creator API", "bot_ready": bot_connected, "bot_user": str(bot_user) if bot_user else None}
 
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    if STATUS_CHECK_UPSERT:
+        status_check = await db.status_checks.find_one_and_update(
+            {"client_name": status_obj.client_name},
+            {
+                "$set": {"timestamp": status_obj.timestamp},
+                "$setOnInsert": {"id": status_obj.id},
+                "$inc": {"count": 1},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return StatusCheck(**status_check)
+    await status_check_logs.add(status_obj.dict())
     return status_obj
 
+@api_router.get("/status/summary", response_model=List[StatusCheckSummary])
+async def get_status_summary():
+    """Get the latest heartbeat and heartbeat count for each client"""
+    summaries = await db.status_checks.aggregate([
+        {"$sort": {"client_name": 1, "timestamp": -1}},
+        {"$group": {
+            "_id": "$client_name",
+            "last_seen": {"$first": "$timestamp"},
+            "count": {"$sum": {"$ifNull": ["$count", 1]}},
+        }},
+        {"$sort": {"last_seen": -1}},
+    ]).to_list(None)
+    return [
+        StatusCheckSummary(client_name=summary["_id"], last_seen=summary["last_seen"], count=summary["count"])
+        for summary in summaries
+    ]
+
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+async def get_status_checks(request: Request, response: Response, limit: int = Query(1000, ge=1, le=1000), cursor: Optional[str] = None):
+    status_checks = await paginate(db.status_checks, "timestamp", limit, cursor, response)
+    return encoded_response(request, [StatusCheck(**status_check) for status_check in status_checks], response)
 
 @api_router.post("/templates/upload")
 async def upload_template(file: UploadFile = File(...)):
@@ -281,131 +2644,750 @@ async def upload_template(file: UploadFile = File(...)):
         if not file.filename.endswith('.json'):
             raise HTTPException(status_code=400, detail="File must be a JSON file")
         
-        content = await file.read()
-        template_data = json.loads(content.decode('utf-8'))
+        content = await read_upload(file, TEMPLATE_UPLOAD_MAX_BYTES)
+        template_data = json.loads(content)
         
         # Validate and create template object
         template = DiscordTemplate(**template_data)
+        plan, errors = compile_template(template)
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
         
-        # Save to database
-        template_dict = template.dict()
-        await db.discord_templates.insert_one(template_dict)
+        # Save to database along with the compiled build plan
+        [(template_id, duplicate)] = await store_templates([(template, plan)])
+        template_cache.invalidate(template_id)
+        await response_cache.invalidate("templates")
         
         return {
             "success": True,
-            "message": "Template uploaded successfully",
-            "template_id": template.id,
-            "template_name": template.name
+            "message": "Template already uploaded" if duplicate else "Template uploaded successfully",
+            "template_id": template_id,
+            "template_name": template.name,
+            "version": template.version,
+            "duplicate": duplicate
         }
         
-    except json.JSONDecodeError:
+    except HTTPException:
+        raise
+    except (json.JSONDecodeError, UnicodeDecodeError):
         raise HTTPException(status_code=400, detail="Invalid JSON file")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing template: {str(e)}")
 
-@api_router.get("/templates", response_model=List[DiscordTemplate])
-async def get_templates():
-    """Get all uploaded templates"""
-    templates = await db.discord_templates.find().to_list(1000)
-    return [DiscordTemplate(**template) for template in templates]
+@api_router.post("/templates/upload/bulk")
+async def upload_templates_bulk(request: Request):
+    """Upload many templates from an NDJSON stream or a zip of JSON files"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        documents = iter_ndjson_templates(request)
+    elif content_type in ("application/zip", "application/x-zip-compressed"):
+        documents = iter_zip_templates(request)
+    else:
+        raise HTTPException(status_code=415, detail="Send templates as application/x-ndjson or application/zip")
+
+    template_ids = []
+    duplicates = 0
+    errors = []
+    batch = []
+
+    async def flush():
+        nonlocal duplicates
+        for template_id, duplicate in await store_templates(batch):
+            template_ids.append(template_id)
+            duplicates += duplicate
+        batch.clear()
+
+    async for source, data in documents:
+        if data is None:
+            errors.append({"source": source, "error": f"Template exceeds the {TEMPLATE_UPLOAD_MAX_BYTES} byte limit"})
+            continue
+        try:
+            template, plan = parse_template(data.decode('utf-8'))
+        except UnicodeDecodeError:
+            errors.append({"source": source, "error": "Invalid UTF-8"})
+            continue
+        except json.JSONDecodeError:
+            errors.append({"source": source, "error": "Invalid JSON"})
+            continue
+        except Exception as e:
+            errors.append({"source": source, "error": str(e)})
+            continue
+
+        batch.append((template, plan))
+        if len(batch) >= TEMPLATE_BULK_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+
+    for template_id in template_ids:
+        template_cache.invalidate(template_id)
+    await response_cache.invalidate("templates")
+
+    return {
+        "success": not errors,
+        "message": f"Uploaded {len(template_ids) - duplicates} templates, {duplicates} already stored",
+        "template_ids": template_ids,
+        "duplicates": duplicates,
+        "errors": errors
+    }
+
+# Field of template_stats each usage ordering of the template list pages by
+TEMPLATE_SORT_FIELDS = {"popular": "uses", "recent": "last_used_at"}
+
+@api_router.get("/templates", response_model=List[Union[DiscordTemplate, DiscordTemplateSummary]])
+async def get_templates(request: Request, response: Response, limit: int = Query(1000, ge=1, le=1000), cursor: Optional[str] = None, summary: bool = False, sort: Literal["created", "popular", "recent"] = "created"):
+    """Get uploaded templates, newest first, or the ones built from most or most recently"""
+    projection = {"channels": 0, "roles": 0, "build_plan": 0, "payload": 0} if summary else {"build_plan": 0}
+    if sort == "created":
+        templates = await paginate(db.discord_templates, "created_at", limit, cursor, response, projection)
+    else:
+        # Ranked from the indexed usage counters; templates never built aren't listed
+        ranked = await paginate(db.template_stats, TEMPLATE_SORT_FIELDS[sort], limit, cursor, response, {"id": 1, TEMPLATE_SORT_FIELDS[sort]: 1})
+        template_ids = [doc["id"] for doc in ranked]
+        found = {
+            template["id"]: template
+            for template in await db.discord_templates.find({"id": {"$in": template_ids}}, projection).to_list(len(template_ids))
+        }
+        templates = [found[template_id] for template_id in template_ids if template_id in found]
+    if summary:
+        return encoded_response(request, [DiscordTemplateSummary(**template) for template in templates], response)
+    return encoded_response(request, [DiscordTemplate(**expand_template_document(template)) for template in templates], response)
+
+@api_router.get("/templates/stats", response_model=List[TemplateStatsSummary])
+async def get_template_stats():
+    """Get build counts, failures and average build time per template, most used first"""
+    await template_stats.refresh()
+    return template_stats.summaries()
+
+@api_router.get("/templates/cache/stats")
+async def get_template_cache_stats():
+    """Get template cache size and hit/miss counters"""
+    return template_cache.stats()
+
+@api_router.get("/templates/{template_id}/versions", response_model=List[DiscordTemplateSummary])
+async def get_template_versions(template_id: str):
+    """Get every stored version of a template, newest first"""
+    template_data = await db.discord_templates.find_one({"id": template_id}, {"name": 1})
+    if not template_data:
+        raise HTTPException(status_code=404, detail="Template not found")
+    versions = await db.discord_templates.find(
+        {"name": template_data["name"]}, {"channels": 0, "roles": 0, "build_plan": 0, "payload": 0}
+    ).sort("version", -1).to_list(1000)
+    return [DiscordTemplateSummary(**version) for version in versions]
 
 @api_router.get("/templates/{template_id}")
 async def get_template(template_id: str):
     """Get a specific template by ID"""
-    template = await db.discord_templates.find_one({"id": template_id})
-    if not template:
+    cached = await template_cache.get(template_id)
+    if not cached:
         raise HTTPException(status_code=404, detail="Template not found")
-    return DiscordTemplate(**template)
+    return cached[0]
 
 @api_router.post("/servers/create", response_model=ServerCreationResponse)
-async def create_server(request: ServerCreationRequest):
+async def create_server(request: ServerCreationRequest, idempotency_key: Optional[str] = Header(None)):
     """Create a Discord server from template"""
+    idempotency_key = request.idempotency_key or idempotency_key or str(uuid.uuid4())
     try:
         # Get template from database
-        template_data = await db.discord_templates.find_one({"id": request.template_id})
-        if not template_data:
+        cached = await template_cache.get(request.template_id)
+        if not cached:
             raise HTTPException(status_code=404, detail="Template not found")
         
-        template = DiscordTemplate(**template_data)
+        template, plan = cached
+        
+        if SERVER_CREATION_QUEUE == "mongo":
+            # A bot worker builds the server and saves the creation log
+            job = await job_queue.enqueue(template.id, request.server_name, idempotency_key)
+            return await job_queue.wait(job.id, SERVER_CREATION_TIMEOUT)
         
         # Create the server
-        result = await create_discord_server(template, request.server_name)
+        result = await create_discord_server(template, request.server_name, plan=plan, idempotency_key=idempotency_key)
         
         # Save server creation log
-        if result.success:
-            server_log = {
-                "id": str(uuid.uuid4()),
-                "template_id": request.template_id,
-                "server_name": request.server_name,
-                "server_id": result.server_id,
-                "invite_link": result.invite_link,
-                "created_at": datetime.utcnow(),
-                "success": True
-            }
-            await db.created_servers.insert_one(server_log)
+        await log_created_server(request.template_id, request.server_name, result)
         
         return result
         
     except Exception as e:
         return ServerCreationResponse(
             success=False,
-            message=f"Error creating server: {str(e)}"
+            message=f"Error creating server: {str(e)}",
+            idempotency_key=idempotency_key
+        )
+
+# Running batches, referenced here so they outlive a disconnected client
+server_creation_batches = set()
+
+@api_router.post("/servers/create-batch")
+async def create_servers_batch(request: ServerBatchCreationRequest, idempotency_key: Optional[str] = Header(None)):
+    """Create several Discord servers from one template, streaming results as NDJSON"""
+    if not request.server_names:
+        raise HTTPException(status_code=400, detail="server_names must not be empty")
+    if len(request.server_names) > SERVER_CREATION_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {SERVER_CREATION_BATCH_MAX} servers per batch")
+
+    # The template is fetched and compiled once for the whole batch
+    cached = await template_cache.get(request.template_id)
+    if not cached:
+        raise HTTPException(status_code=404, detail="Template not found")
+    template, plan = cached
+    batch_key = request.idempotency_key or idempotency_key or str(uuid.uuid4())
+
+    # Feed the pipeline no faster than its workers drain it, so a batch shares the
+    # worker pool and rate limits with other requests instead of filling the queue
+    slots = asyncio.Semaphore(SERVER_CREATION_CONCURRENCY)
+    results = asyncio.Queue()
+
+    async def build(index: int, server_name: str):
+        key = f"{batch_key}:{index}"
+        async with slots:
+            try:
+                if SERVER_CREATION_QUEUE == "mongo":
+                    job = await job_queue.enqueue(template.id, server_name, key)
+                    result = await job_queue.wait(job.id, SERVER_CREATION_JOB_TIMEOUT)
+                else:
+                    result = await create_discord_server(template, server_name, timeout=SERVER_CREATION_JOB_TIMEOUT, plan=plan, idempotency_key=key)
+            except Exception as e:
+                result = ServerCreationResponse(
+                    success=False,
+                    message=f"Error creating server: {str(e)}",
+                    idempotency_key=key
+                )
+        await results.put((index, server_name, result))
+        return server_name, result
+
+    async def run_batch():
+        built = await asyncio.gather(*(build(index, name) for index, name in enumerate(request.server_names)))
+        if SERVER_CREATION_QUEUE != "mongo":
+            # Bot workers log their own builds in mongo mode
+            try:
+                await log_created_servers(template.id, built)
+            except Exception as e:
+                logger.error(f"Error saving creation logs for batch {batch_key}: {e}")
+
+    # The batch keeps running and gets logged even if the client disconnects
+    batch = asyncio.create_task(run_batch())
+    server_creation_batches.add(batch)
+    batch.add_done_callback(server_creation_batches.discard)
+
+    async def stream():
+        for _ in request.server_names:
+            index, server_name, result = await results.get()
+            yield json.dumps({"index": index, "server_name": server_name, **result.dict()}) + "\n"
+        await asyncio.shield(batch)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@api_router.post("/servers/{server_id}/sync", response_model=ServerSyncResponse)
+async def sync_server(server_id: str, request: ServerSyncRequest):
+    """Bring an existing Discord server in line with a template by applying only the differences"""
+    try:
+        guild_id = int(server_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid server id")
+
+    server_log = await db.created_servers.find_one({"server_id": server_id}, {"template_id": 1})
+    template_id = request.template_id or (server_log or {}).get("template_id")
+    if not template_id:
+        raise HTTPException(status_code=404, detail="Server not found")
+    cached = await template_cache.get(template_id)
+    if not cached:
+        raise HTTPException(status_code=404, detail="Template not found")
+    _, plan = cached
+
+    if not bot_ready_event.is_set():
+        return ServerSyncResponse(success=False, server_id=server_id, message="Discord bot is not ready. Please try again.")
+
+    try:
+        async with discord_request("fetch_roles", guild_id):
+            roles = await bot.http.get_roles(guild_id)
+        async with discord_request("fetch_channels", guild_id):
+            channels = await bot.http.get_all_guild_channels(guild_id)
+    except (discord.NotFound, discord.Forbidden):
+        raise HTTPException(status_code=404, detail="Server not found on Discord")
+    except discord.HTTPException as e:
+        return ServerSyncResponse(success=False, server_id=server_id, message=f"Discord API error: {str(e)}")
+
+    sync = GuildSync(guild_id, plan, roles, channels, request.delete_extra)
+    if not sync.operations:
+        return ServerSyncResponse(success=True, server_id=server_id, message="Server already matches the template")
+    if request.dry_run:
+        return ServerSyncResponse(
+            success=True,
+            server_id=server_id,
+            message=f"{len(sync.operations)} changes needed",
+            operations=sync.operations
         )
 
+    errors = await sync.apply()
+    if server_log:
+        await db.created_servers.update_one(
+            {"server_id": server_id},
+            {"$set": {"template_id": template_id, "synced_at": datetime.utcnow()}}
+        )
+        await response_cache.invalidate("servers")
+    return ServerSyncResponse(
+        success=not errors,
+        server_id=server_id,
+        message=f"Applied {len(sync.operations) - len(errors)} of {len(sync.operations)} changes",
+        operations=sync.operations,
+        errors=errors
+    )
+
+@api_router.get("/servers/{server_id}/invite")
+async def get_server_invite(server_id: str, refresh: bool = False):
+    """Get a server's invite link, creating a new one if it has none or refresh is set"""
+    if not server_id.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid server id")
+    if not bot_ready_event.is_set() and (refresh or not invites.cached(server_id)):
+        server_log = await db.created_servers.find_one({"server_id": server_id}, {"invite_link": 1})
+        if refresh or not (server_log and server_log.get("invite_link")):
+            raise HTTPException(status_code=503, detail="Discord bot is not ready. Please try again.")
+    try:
+        invite_link = await invites.get(server_id, refresh)
+    except (discord.NotFound, discord.Forbidden):
+        raise HTTPException(status_code=404, detail="Server not found on Discord")
+    if not invite_link:
+        raise HTTPException(status_code=404, detail="Server has no text channel to invite to")
+    return {"server_id": server_id, "invite_link": invite_link}
+
+@api_router.post("/servers/jobs", response_model=ServerCreationJob, status_code=202)
+async def create_server_job(request: ServerCreationRequest, idempotency_key: Optional[str] = Header(None)):
+    """Queue a Discord server build and return its job right away"""
+    cached = await template_cache.get(request.template_id)
+    if not cached:
+        raise HTTPException(status_code=404, detail="Template not found")
+
+    template, plan = cached
+    idempotency_key = request.idempotency_key or idempotency_key
+    if SERVER_CREATION_QUEUE == "mongo":
+        return await job_queue.enqueue(template.id, request.server_name, idempotency_key)
+    return await server_creation_jobs.start(template, request.server_name, plan, idempotency_key)
+
+@api_router.get("/servers/jobs/{job_id}", response_model=ServerCreationJob)
+async def get_server_job(job_id: str):
+    """Get the status and progress of a server creation job"""
+    job = await server_creation_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.get("/servers/jobs/{job_id}/events")
+async def stream_server_job(job_id: str):
+    """Stream server creation job progress as server-sent events"""
+    job = await server_creation_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        current = job
+        updates = None
+        if job_id in server_creation_jobs.jobs:
+            current = server_creation_jobs.jobs[job_id].copy(deep=True)
+            updates = server_creation_jobs.subscribe(job_id)
+        try:
+            yield f"event: progress\ndata: {current.json()}\n\n"
+            while current.status not in ("completed", "failed"):
+                if updates is None:
+                    # The job runs elsewhere, so follow it through the database
+                    await asyncio.sleep(1)
+                    latest = await server_creation_jobs.get(job_id)
+                    if not latest or latest.updated_at == current.updated_at:
+                        continue
+                    current = latest
+                else:
+                    try:
+                        current = await asyncio.wait_for(updates.get(), 15)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                yield f"event: progress\ndata: {current.json()}\n\n"
+        finally:
+            if updates is not None:
+                server_creation_jobs.unsubscribe(job_id, updates)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@api_router.get("/servers/queue")
+async def get_server_queue_stats():
+    """Get server creation queue depth and wait time metrics"""
+    return server_creation_dispatcher.stats()
+
 @api_router.get("/servers/created")
-async def get_created_servers():
+async def get_created_servers(request: Request, response: Response, limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None):
     """Get list of created servers"""
-    servers = await db.created_servers.find().sort("created_at", -1).to_list(100)
+    servers = await paginate(db.created_servers, "created_at", limit, cursor, response)
     # Convert MongoDB ObjectId to string for JSON serialization
     for server in servers:
         if '_id' in server:
             del server['_id']  # Remove MongoDB ObjectId
-    return servers
+    return encoded_response(request, servers, response)
 
 @api_router.delete("/templates/{template_id}")
 async def delete_template(template_id: str):
     """Delete a template"""
     result = await db.discord_templates.delete_one({"id": template_id})
+    template_cache.invalidate(template_id)
+    await template_stats.remove(template_id)
+    await response_cache.invalidate("templates")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Template not found")
     return {"success": True, "message": "Template deleted successfully"}
 
+class PipelineCollector:
+    """Exposes dispatcher and template cache counters to Prometheus"""
+
+    def collect(self):
+        stats = server_creation_dispatcher.stats()
+        yield GaugeMetricFamily("server_creation_queue_depth", "Server creation jobs waiting for a worker", value=stats["queue_depth"])
+        yield GaugeMetricFamily("server_creation_in_progress", "Server creation jobs being built", value=stats["in_progress"])
+        yield CounterMetricFamily("server_creation_completed", "Server creation jobs finished", value=stats["completed"])
+        yield CounterMetricFamily("server_creation_rejected", "Server creation jobs rejected by backpressure", value=stats["rejected"])
+
+        cache = template_cache.stats()
+        yield GaugeMetricFamily("template_cache_size", "Templates held in the cache", value=cache["size"])
+        yield CounterMetricFamily("template_cache_hits", "Template cache hits", value=cache["hits"])
+        yield CounterMetricFamily("template_cache_misses", "Template cache misses", value=cache["misses"])
+
+REGISTRY.register(PipelineCollector())
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the process is up and its event loop is serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: Mongo answers and, when this process builds guilds, the gateway is connected"""
+    try:
+        await asyncio.wait_for(db.command("ping"), READINESS_MONGO_TIMEOUT)
+        mongo_ready = True
+    except Exception:
+        mongo_ready = False
+    # Replicas that only enqueue jobs for bot workers don't need a gateway connection
+    bot_required = SERVER_CREATION_QUEUE == "local"
+    latency = bot.latency
+    checks = {
+        "mongo": mongo_ready,
+        "bot": bot_connected_event.is_set() and not bot.is_closed(),
+        "bot_latency_ms": round(latency * 1000, 1) if latency == latency and latency != float("inf") else None,
+    }
+    ready = mongo_ready and (checks["bot"] or not bot_required)
+    return JSONResponse({"ready": ready, **checks}, status_code=200 if ready else 503)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics for the creation pipeline"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# Response cache
+class MemoryCacheBackend:
+    """Response cache storage local to this process"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def generations(self, tags: List[str]) -> List[int]:
+        return [self._generations.get(tag, 0) for tag in tags]
+
+    async def bump(self, tag: str):
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+
+class RedisCacheBackend:
+    """Response cache storage shared by replicas through Redis or a compatible server"""
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis  # Only needed for the shared backend
+        self.redis = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.redis.get(f"response-cache:{key}")
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.redis.set(f"response-cache:{key}", value, px=int(ttl * 1000))
+
+    async def generations(self, tags: List[str]) -> List[int]:
+        values = await self.redis.mget([f"response-cache-generation:{tag}" for tag in tags])
+        return [int(value or 0) for value in values]
+
+    async def bump(self, tag: str):
+        await self.redis.incr(f"response-cache-generation:{tag}")
+
+class ResponseCache:
+    """ASGI middleware caching GET responses of read-heavy routes with an ETag
+
+    Each route has a TTL and tags. Mutating routes bump a tag's generation,
+    which is part of every cache key, so stale entries are never read again.
+    There is no Last-Modified: a second-resolution fill time would answer 304
+    for a change made within the same second, so revalidation uses the ETag.
+    """
+
+    # (name, path pattern, TTL seconds, tags)
+    ROUTES = [
+        ("root", re.compile(r"/api/"), 5, []),
+        ("templates", re.compile(r"/api/templates"), 30, ["templates"]),
+        ("template_stats", re.compile(r"/api/templates/stats"), 5, ["templates"]),
+        ("template", re.compile(r"/api/templates/[^/]+"), 300, ["templates"]),
+        ("created_servers", re.compile(r"/api/servers/created"), 10, ["servers"]),
+    ]
+
+    def __init__(self, backend: Optional[Any]):
+        self.backend = backend
+
+    async def invalidate(self, tag: str):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.bump(tag)
+        except Exception as e:
+            logger.warning(f"Response cache invalidation of {tag} failed: {e}")
+
+    def route(self, scope) -> Optional[Tuple[str, Any, float, List[str]]]:
+        if self.backend is None or scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        return next((route for route in self.ROUTES if route[1].fullmatch(scope["path"])), None)
+
+    async def _key(self, scope, headers: Headers, tags: List[str]) -> str:
+        # Responses differ by encoding and format, so those belong in the key
+        variant = (
+            "gzip" if "gzip" in headers.get("accept-encoding", "") else "identity",
+            "msgpack" if "application/msgpack" in headers.get("accept", "") else "json",
+        )
+        generations = await self.backend.generations(tags) if tags else []
+        query = scope.get("query_string", b"").decode("latin-1")
+        return hashlib.sha256(repr((scope["path"], query, variant, generations)).encode()).hexdigest()
+
+    async def serve(self, route, app, scope, receive, send):
+        name, _, ttl, tags = route
+        headers = Headers(scope=scope)
+        try:
+            key = await self._key(scope, headers, tags)
+            cached = None if "no-cache" in headers.get("cache-control", "") else await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+            return await app(scope, receive, send)
+
+        if cached is not None:
+            meta, body = cached.split(b"\n", 1)
+            meta = json.loads(meta)
+            result = await self._send(send, headers, meta["status"], meta["headers"], body)
+            RESPONSE_CACHE_REQUESTS.labels(name, "not_modified" if result == 304 else "hit").inc()
+            return
+
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body"):
+                return
+            body = b"".join(chunks)
+            response_headers = MutableHeaders(raw=list(start["headers"]))
+            if start["status"] == 200 and "set-cookie" not in response_headers and len(body) <= RESPONSE_CACHE_MAX_BYTES:
+                if "etag" not in response_headers:
+                    response_headers["ETag"] = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                response_headers["Cache-Control"] = "no-cache"
+                raw = [[k.decode("latin-1"), v.decode("latin-1")] for k, v in response_headers.raw]
+                try:
+                    await self.backend.set(key, json.dumps({"status": 200, "headers": raw}).encode() + b"\n" + body, ttl)
+                except Exception as e:
+                    logger.warning(f"Response cache store failed: {e}")
+            raw = [[k.decode("latin-1"), v.decode("latin-1")] for k, v in response_headers.raw]
+            result = await self._send(send, headers, start["status"], raw, body)
+            RESPONSE_CACHE_REQUESTS.labels(name, "not_modified" if result == 304 else "miss").inc()
+
+        await app(scope, receive, capture)
+
+    async def _send(self, send, request_headers: Headers, status: int, raw_headers: List[List[str]], body: bytes) -> int:
+        response_headers = MutableHeaders(raw=[(k.encode("latin-1"), v.encode("latin-1")) for k, v in raw_headers])
+        if status == 200 and self._not_modified(request_headers, response_headers):
+            status, body = 304, b""
+            del response_headers["content-length"]
+            del response_headers["content-type"]
+            del response_headers["content-encoding"]
+        else:
+            response_headers["content-length"] = str(len(body))
+        await send({"type": "http.response.start", "status": status, "headers": response_headers.raw})
+        await send({"type": "http.response.body", "body": body})
+        return status
+
+    @staticmethod
+    def _not_modified(request_headers: Headers, response_headers: MutableHeaders) -> bool:
+        if_none_match = request_headers.get("if-none-match")
+        etag = response_headers.get("etag")
+        if if_none_match is None or not etag:
+            return False
+        return if_none_match.strip() == "*" or etag.removeprefix("W/") in {
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        }
+
+def create_response_cache_backend() -> Optional[Any]:
+    if RESPONSE_CACHE_BACKEND == "redis":
+        try:
+            return RedisCacheBackend(RESPONSE_CACHE_REDIS_URL)
+        except ImportError:
+            logger.warning("redis is not installed, falling back to the in-memory response cache")
+    if RESPONSE_CACHE_BACKEND == "off":
+        return None
+    return MemoryCacheBackend(RESPONSE_CACHE_MAX_ENTRIES)
+
+response_cache = ResponseCache(create_response_cache_backend())
+
+class ResponseCacheMiddleware:
+    def __init__(self, app, cache: ResponseCache):
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        route = self.cache.route(scope)
+        if route is None:
+            return await self.app(scope, receive, send)
+        await self.cache.serve(route, self.app, scope, receive, send)
+
+class UploadSizeLimitMiddleware:
+    """Rejects an oversized request body before FastAPI spools it for form parsing
+
+    A Content-Length over the limit is answered with 413 without reading the
+    body; otherwise the body is counted as it arrives and reading stops with
+    413 as soon as it passes the limit.
+    """
+
+    def __init__(self, app, paths: List[str], max_bytes: int):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        detail = f"Template exceeds the {TEMPLATE_UPLOAD_MAX_BYTES} byte limit"
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+            return await response(scope, receive, send)
+
+        size = 0
+
+        async def limited_receive():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                size += len(message.get("body", b""))
+                if size > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from reading the body
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Inside CORS, so cached responses still get CORS headers
+app.add_middleware(ResponseCacheMiddleware, cache=response_cache)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    paths=["/api/templates/upload"],
+    max_bytes=TEMPLATE_UPLOAD_MAX_BYTES + TEMPLATE_UPLOAD_MULTIPART_OVERHEAD,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+async def run_bot():
+    """Run the Discord bot until it is closed"""
+    try:
+        if DISCORD_SIMULATOR:
+            from discord_simulator import DiscordSimulator, run_simulated_bot
+            simulator = DiscordSimulator.from_env(on_rate_limit=record_discord_rate_limit)
+            await run_simulated_bot(bot, simulator)
+        else:
+            await bot.start(os.environ['DISCORD_BOT_TOKEN'])
+    except Exception as e:
+        logger.error(f"Error starting Discord bot: {e}")
+
+async def startup_checks():
+    """Create indexes and report a bot that hasn't logged in within BOT_READY_TIMEOUT"""
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Error creating MongoDB indexes: {e}")
+
+    try:
+        await prewarm_template_cache()
+    except Exception as e:
+        logger.error(f"Error pre-warming the template cache: {e}")
 
-@app.on_event("startup")
-async def startup_event():
-    """Start Discord bot in background"""
-    def run_bot():
+    if SERVER_CREATION_QUEUE == "local":
         try:
-            bot.run(os.environ['DISCORD_BOT_TOKEN'])
-        except Exception as e:
-            print(f"Error starting Discord bot: {e}")
-    
-    # Start bot in a separate thread
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
+            await asyncio.wait_for(bot_ready_event.wait(), BOT_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Discord bot is not ready yet, server creation will be unavailable until it logs in")
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the bot on the application loop alongside the API"""
+    # Unless bot workers own the Discord side
+    if SERVER_CREATION_QUEUE == "local":
+        server_creation_dispatcher.start()
+        app.state.bot_task = asyncio.create_task(run_bot())
     
-    # Give the bot a moment to start
-    await asyncio.sleep(2)
+    # Startup doesn't wait on Mongo or the gateway; /readyz holds traffic back until both are up
+    app.state.startup_checks = asyncio.create_task(startup_checks())
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
-    if bot:
+    # Keep template caches coherent across API replicas
+    if TEMPLATE_CACHE_CHANGE_STREAM:
+        app.state.template_cache_watcher = asyncio.create_task(template_cache.watch())
+
+    yield
+
+    # Let jobs and batches, then any other in-flight builds, then their invites finish
+    # within the drain timeout, so their logs are buffered before the flush. Requests
+    # have stopped by now, so the dispatcher keeps accepting the builds jobs still queue.
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    await server_creation_jobs.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    if server_creation_batches:
+        _, pending = await asyncio.wait(list(server_creation_batches), timeout=max(0.0, deadline - time.monotonic()))
+        if pending:
+            logger.warning(f"Shutting down with {len(pending)} server creation batches unfinished")
+    await server_creation_dispatcher.drain(max(0.0, deadline - time.monotonic()))
+    await invites.drain(max(0.0, deadline - time.monotonic()))
+    await flush_logs()
+    app.state.startup_checks.cancel()
+    watcher = getattr(app.state, "template_cache_watcher", None)
+    if watcher:
+        watcher.cancel()
+    bot_task = getattr(app.state, "bot_task", None)
+    if bot_task:
         await bot.close()
+        await asyncio.gather(bot_task, return_exceptions=True)
+    client.close()
+
+app.router.lifespan_context = lifespan
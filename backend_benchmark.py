@@ -0,0 +1,134 @@
+import requests
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+class DiscordServerCreatorBenchmark:
+    """Load test for the creation path, meant to run against a backend started with DISCORD_SIMULATOR=true"""
+
+    def __init__(self, base_url, concurrency, template_path):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.template_path = template_path
+        self.template_id = None
+        self.results = {}
+
+    def timed_request(self, name, method, endpoint, **kwargs):
+        """Send one request and record its latency under name"""
+        url = f"{self.base_url}/{endpoint}"
+        start = time.perf_counter()
+        try:
+            response = requests.request(method, url, timeout=300, **kwargs)
+            ok = response.status_code < 400
+        except Exception:
+            response = None
+            ok = False
+        elapsed = time.perf_counter() - start
+        self.results.setdefault(name, []).append((elapsed, ok))
+        return response
+
+    def scrape_metrics(self):
+        """Sum the Discord REST call and 429 counters exported at /metrics"""
+        totals = {"discord_calls": 0.0, "rate_limited": 0.0}
+        try:
+            text = requests.get(f"{self.base_url}/metrics", timeout=30).text
+        except Exception:
+            return totals
+        for line in text.splitlines():
+            if line.startswith("discord_request_seconds_count"):
+                totals["discord_calls"] += float(line.rsplit(" ", 1)[1])
+            elif line.startswith("discord_rate_limited_total"):
+                totals["rate_limited"] += float(line.rsplit(" ", 1)[1])
+        return totals
+
+    def upload_template(self):
+        with open(self.template_path, 'rb') as f:
+            content = f.read()
+        response = self.timed_request(
+            "upload", "POST", "api/templates/upload",
+            files={'file': ('benchmark_template.json', content, 'application/json')}
+        )
+        if response is not None and response.status_code == 200:
+            return response.json().get('template_id')
+        return None
+
+    def create_server(self, index):
+        response = self.timed_request(
+            "create", "POST", "api/servers/create",
+            json={
+                "template_id": self.template_id,
+                "server_name": f"Benchmark {datetime.now().strftime('%H%M%S')} #{index}"
+            }
+        )
+        return response is not None and response.status_code == 200 and response.json().get('success')
+
+    def run_phase(self, name, count, func):
+        print(f"\n🔍 {name}: {count} requests at concurrency {self.concurrency}...")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            outcomes = list(pool.map(func, range(count)))
+        return time.perf_counter() - start, outcomes
+
+    def report(self, name):
+        samples = self.results.get(name, [])
+        if not samples:
+            return
+        latencies = sorted(elapsed for elapsed, _ in samples)
+        failures = sum(1 for _, ok in samples if not ok)
+        p50 = statistics.median(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(round(0.99 * (len(latencies) - 1))))]
+        print(f"📊 {name}: n={len(latencies)} p50={p50 * 1000:.1f}ms p99={p99 * 1000:.1f}ms failures={failures}")
+
+    def run(self, builds, list_requests, uploads):
+        print("🚀 Starting Discord Server Creator Benchmark")
+        print(f"Base URL: {self.base_url}")
+
+        self.template_id = self.upload_template()
+        if not self.template_id:
+            print("❌ Template upload failed, cannot benchmark server creation")
+            return False
+
+        if uploads:
+            self.run_phase("Template uploads", uploads, lambda _: self.upload_template())
+
+        if list_requests:
+            self.run_phase(
+                "Template listing", list_requests,
+                lambda _: self.timed_request("list_templates", "GET", "api/templates")
+            )
+
+        if builds:
+            before = self.scrape_metrics()
+            elapsed, outcomes = self.run_phase("Server creation", builds, self.create_server)
+            after = self.scrape_metrics()
+            succeeded = sum(1 for outcome in outcomes if outcome)
+            calls = after["discord_calls"] - before["discord_calls"]
+            print(f"📊 builds: {succeeded}/{builds} succeeded in {elapsed:.1f}s ({succeeded / elapsed * 60:.1f} builds/min)")
+            if succeeded:
+                print(f"📊 discord calls per build: {calls / succeeded:.1f}")
+            print(f"📊 429 responses: {after['rate_limited'] - before['rate_limited']:.0f}")
+
+        print("\n⏱️ Latency")
+        for name in ("upload", "list_templates", "create"):
+            self.report(name)
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Discord Server Creator API")
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--builds", type=int, default=20)
+    parser.add_argument("--list-requests", type=int, default=200)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--template", default="example_template.json")
+    args = parser.parse_args()
+
+    benchmark = DiscordServerCreatorBenchmark(args.base_url, args.concurrency, args.template)
+    success = benchmark.run(args.builds, args.list_requests, args.uploads)
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
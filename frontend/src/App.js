@@ -245,8 +245,14 @@ const Templates = () => {
 
       if (response.data.success) {
         setMessage(`تم إنشاء السيرفر بنجاح! 🎉`);
-        if (response.data.invite_link) {
-          setMessage(prev => prev + ` رابط الدعوة: ${response.data.invite_link}`);
+        let inviteLink = response.data.invite_link;
+        if (!inviteLink && response.data.invite_pending) {
+          // The invite is created after the build returns
+          const invite = await axios.get(`${API}/servers/${response.data.server_id}/invite`).catch(() => null);
+          inviteLink = invite?.data?.invite_link;
+        }
+        if (inviteLink) {
+          setMessage(prev => prev + ` رابط الدعوة: ${inviteLink}`);
         }
         setServerName('');
         setSelectedTemplate(null);
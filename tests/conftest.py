@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py reads these at import; the Mongo client is only created on first use
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
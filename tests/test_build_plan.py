@@ -0,0 +1,80 @@
+from server import BuildPlan, ChannelGroup, EVERYONE, PlannedChannel, PlannedRole, collapse_overwrites, compile_bootstrap_payload
+
+
+def test_bootstrap_roles_are_listed_bottom_up():
+    plan = BuildPlan(roles=[PlannedRole(name="Admin"), PlannedRole(name="Mod"), PlannedRole(name="Member")])
+    payload = compile_bootstrap_payload(plan, "Guild")
+
+    assert payload["roles"][0] == {"id": 0}
+    # Discord gives later roles higher positions, so the plan's top role goes last
+    assert [role["name"] for role in payload["roles"][1:]] == ["Member", "Mod", "Admin"]
+
+
+def test_bootstrap_overwrites_use_role_placeholders():
+    plan = BuildPlan(
+        roles=[PlannedRole(name="Admin"), PlannedRole(name="Member")],
+        groups=[ChannelGroup(
+            category=PlannedChannel(name="Staff", type="category", permissions={EVERYONE: {"view_channel": False}}),
+            channels=[
+                PlannedChannel(name="mods", type="text", permissions={"Admin": {"view_channel": True}}),
+                PlannedChannel(name="lounge", type="text"),
+            ],
+        )],
+    )
+    payload = compile_bootstrap_payload(plan, "Guild")
+    placeholders = {role["name"]: role["id"] for role in payload["roles"][1:]}
+    category, mods, lounge = payload["channels"]
+
+    assert category["permission_overwrites"] == [{"id": 0, "type": 0, "allow": "0", "deny": "1024"}]
+    assert mods["parent_id"] == category["id"]
+    assert mods["permission_overwrites"] == [{"id": placeholders["Admin"], "type": 0, "allow": "1024", "deny": "0"}]
+    # Without overwrites of its own a channel repeats its category's
+    assert lounge["permission_overwrites"] == category["permission_overwrites"]
+
+
+def test_shared_overwrites_move_to_the_category():
+    hidden = {"@everyone": {"allow": 0, "deny": 1024}}
+    group = ChannelGroup(
+        category=PlannedChannel(name="Staff", type="category"),
+        channels=[
+            PlannedChannel(name="mods", type="text", permissions=dict(hidden)),
+            PlannedChannel(name="logs", type="text", permissions=dict(hidden)),
+        ],
+    )
+    collapse_overwrites(group)
+
+    assert group.category.permissions == hidden
+    assert [channel.permissions for channel in group.channels] == [{}, {}]
+
+
+def test_differing_overwrites_stay_on_the_channels():
+    hidden = {"@everyone": {"allow": 0, "deny": 1024}}
+    muted = {"@everyone": {"allow": 0, "deny": 2048}}
+    group = ChannelGroup(
+        category=PlannedChannel(name="Staff", type="category"),
+        channels=[
+            PlannedChannel(name="mods", type="text", permissions=hidden),
+            PlannedChannel(name="logs", type="text", permissions=muted),
+            PlannedChannel(name="lounge", type="text"),
+        ],
+    )
+    collapse_overwrites(group)
+
+    assert group.category.permissions == {}
+    assert [channel.permissions for channel in group.channels] == [hidden, muted, {}]
+
+
+def test_channels_matching_the_category_overwrites_sync_to_it():
+    hidden = {"@everyone": {"allow": 0, "deny": 1024}}
+    muted = {"@everyone": {"allow": 0, "deny": 2048}}
+    group = ChannelGroup(
+        category=PlannedChannel(name="Staff", type="category", permissions=hidden),
+        channels=[
+            PlannedChannel(name="mods", type="text", permissions=dict(hidden)),
+            PlannedChannel(name="logs", type="text", permissions=muted),
+        ],
+    )
+    collapse_overwrites(group)
+
+    assert group.category.permissions == hidden
+    assert [channel.permissions for channel in group.channels] == [{}, muted]
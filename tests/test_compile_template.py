@@ -0,0 +1,95 @@
+from server import DiscordTemplate, compile_template
+
+
+def template(roles=(), channels=()):
+    return DiscordTemplate(name="Guild", roles=list(roles), channels=list(channels))
+
+
+def test_roles_keep_template_order_without_everyone():
+    plan, errors = compile_template(template(roles=[
+        {"name": "@everyone"},
+        {"name": "Admin", "color": "#ff0000", "permissions": 8, "hoist": True},
+        {"name": "Member", "mentionable": None},
+    ]))
+
+    assert errors == []
+    assert [(role.name, role.color, role.permissions, role.hoist, role.mentionable) for role in plan.roles] == [
+        ("Admin", 0xFF0000, 8, True, True),
+        ("Member", 0, 0, False, True),
+    ]
+
+
+def test_invalid_roles_are_left_out_and_reported():
+    plan, errors = compile_template(template(roles=[
+        {"name": "Admin"},
+        {"name": "Admin"},
+        {"name": "Red", "color": "red"},
+        {"name": "Huge", "permissions": -1},
+    ]))
+
+    assert [role.name for role in plan.roles] == ["Admin"]
+    assert errors == [
+        "Duplicate role 'Admin'",
+        "Role 'Red' has invalid color 'red'",
+        "Role 'Huge' has invalid permissions -1",
+    ]
+
+
+def test_channels_are_grouped_and_sorted_by_position():
+    plan, errors = compile_template(template(channels=[
+        {"name": "general", "type": "text", "category": "Text", "position": 1},
+        {"name": "rules", "type": "text", "category": "Text", "position": 0},
+        {"name": "Voice", "type": "category", "position": 2},
+        {"name": "Text", "type": "category", "position": 1},
+        {"name": "lobby", "type": "voice", "category": "Voice"},
+        {"name": "welcome", "type": "text"},
+    ]))
+
+    assert errors == []
+    assert [(group.category.name if group.category else None, [channel.name for channel in group.channels]) for group in plan.groups] == [
+        (None, ["welcome"]),
+        ("Text", ["rules", "general"]),
+        ("Voice", ["lobby"]),
+    ]
+
+
+def test_invalid_channels_are_left_out_and_reported():
+    plan, errors = compile_template(template(
+        roles=[{"name": "Admin"}],
+        channels=[
+            {"name": "stage", "type": "stage"},
+            {"name": "Text", "type": "category"},
+            {"name": "Text", "type": "category"},
+            {"name": "orphan", "type": "text", "category": "Missing"},
+            {"name": "general", "type": "text", "category": "Text"},
+            {"name": "general", "type": "text", "category": "Text"},
+            {"name": "secret", "type": "text", "permissions": {"Ghost": {"view_channel": True}, "Admin": "allow"}},
+        ],
+    ))
+
+    assert errors == [
+        "Channel 'stage' has unknown type 'stage'",
+        "Duplicate category 'Text'",
+        "Channel 'secret' has permissions for unknown role 'Ghost'",
+        "Channel 'secret' permissions for 'Admin' must be an object",
+        "Channel 'orphan' references unknown category 'Missing'",
+        "Duplicate channel 'general' in category 'Text'",
+    ]
+    assert [[channel.name for channel in group.channels] for group in plan.groups] == [["secret"], ["general"]]
+    assert plan.groups[0].channels[0].permissions == {}
+
+
+def test_permissions_are_compiled_to_bits_by_role_name():
+    plan, errors = compile_template(template(
+        roles=[{"name": "Admin"}],
+        channels=[{"name": "mods", "type": "text", "permissions": {
+            "@Everyone": {"view_channel": False},
+            "Admin": {"allow": 1024, "deny": 0},
+        }}],
+    ))
+
+    assert errors == []
+    assert plan.groups[0].channels[0].permissions == {
+        "@everyone": {"allow": 0, "deny": 1024},
+        "Admin": {"allow": 1024, "deny": 0},
+    }
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from server import decode_cursor, encode_cursor
+
+
+@pytest.mark.parametrize("sort_value", [datetime(2024, 5, 1, 12, 30, 15, 250000), 42, 0])
+def test_cursor_round_trips(sort_value):
+    assert decode_cursor(encode_cursor(sort_value, "abc")) == (sort_value, "abc")
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(datetime(2024, 5, 1), "id/with+chars?")
+    assert all(char.isalnum() or char in "-_=" for char in cursor)
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "bm90IGpzb24=", encode_cursor(1, "a")[:-4], "WzFd"])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
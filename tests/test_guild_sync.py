@@ -0,0 +1,134 @@
+from server import BuildPlan, ChannelGroup, GuildSync, PlannedChannel, PlannedRole
+
+GUILD_ID = 1000
+
+
+def role(role_id, name, position, **fields):
+    data = {
+        "id": str(role_id),
+        "name": name,
+        "position": position,
+        "color": 0,
+        "permissions": "0",
+        "hoist": False,
+        "mentionable": True,
+    }
+    data.update(fields)
+    return data
+
+
+def channel(channel_id, name, channel_type, position, parent_id=None, overwrites=()):
+    return {
+        "id": str(channel_id),
+        "name": name,
+        "type": channel_type,
+        "position": position,
+        "parent_id": str(parent_id) if parent_id else None,
+        "permission_overwrites": list(overwrites),
+    }
+
+
+def plan(*names):
+    return BuildPlan(roles=[PlannedRole(name=name) for name in names])
+
+
+def channel_plan(*channels, permissions=None):
+    """A plan with one "Text" category holding the given text channels"""
+    return BuildPlan(groups=[
+        ChannelGroup(),
+        ChannelGroup(
+            category=PlannedChannel(name="Text", type="category", permissions=permissions or {}),
+            channels=[PlannedChannel(name=name, type="text", position=position) for position, name in enumerate(channels)],
+        ),
+    ])
+
+
+def everyone():
+    return role(GUILD_ID, "@everyone", 0)
+
+
+def test_roles_in_plan_order_need_no_changes():
+    roles = [everyone(), role(1, "Admin", 3), role(2, "Mod", 2), role(3, "Member", 1)]
+    sync = GuildSync(GUILD_ID, plan("Admin", "Mod", "Member"), roles, [])
+    assert sync.operations == []
+
+
+def test_reversed_roles_are_moved():
+    roles = [everyone(), role(1, "Admin", 1), role(2, "Mod", 2), role(3, "Member", 3)]
+    sync = GuildSync(GUILD_ID, plan("Admin", "Mod", "Member"), roles, [])
+    assert [(op.action, op.kind) for op in sync.operations] == [("move", "role")]
+    assert sync.operations[0].changes == {"order": ["Admin", "Mod", "Member"]}
+
+
+def test_new_role_at_the_bottom_is_not_moved():
+    roles = [everyone(), role(1, "Admin", 2), role(2, "Mod", 1)]
+    sync = GuildSync(GUILD_ID, plan("Admin", "Mod", "Member"), roles, [])
+    assert [(op.action, op.name) for op in sync.operations] == [("create", "Member")]
+
+
+def test_new_role_above_existing_ones_is_moved():
+    roles = [everyone(), role(2, "Mod", 2), role(3, "Member", 1)]
+    sync = GuildSync(GUILD_ID, plan("Admin", "Mod", "Member"), roles, [])
+    assert [(op.action, op.name) for op in sync.operations] == [("create", "Admin"), ("move", "positions")]
+
+
+def test_changed_and_extra_roles():
+    roles = [everyone(), role(1, "Admin", 3, color=0xFF0000), role(2, "Mod", 2), role(9, "Old", 1)]
+    sync = GuildSync(GUILD_ID, plan("Admin", "Mod"), roles, [])
+    assert [(op.action, op.name, op.changes) for op in sync.operations] == [
+        ("edit", "Admin", {"color": 0}),
+        ("delete", "Old", {}),
+    ]
+
+    kept = GuildSync(GUILD_ID, plan("Admin", "Mod"), roles, [], delete_extra=False)
+    assert [op.action for op in kept.operations] == ["edit"]
+
+
+def test_managed_roles_are_left_alone():
+    roles = [everyone(), role(1, "Admin", 2), role(5, "Some Bot", 1, managed=True)]
+    sync = GuildSync(GUILD_ID, plan("Admin"), roles, [])
+    assert sync.operations == []
+
+
+def test_channels_in_plan_order_need_no_changes():
+    channels = [channel(10, "Text", 4, 0), channel(11, "rules", 0, 0, 10), channel(12, "general", 0, 1, 10)]
+    sync = GuildSync(GUILD_ID, channel_plan("rules", "general"), [everyone()], channels)
+    assert sync.operations == []
+
+
+def test_swapped_channels_are_moved_together():
+    channels = [channel(10, "Text", 4, 0), channel(11, "rules", 0, 1, 10), channel(12, "general", 0, 0, 10)]
+    sync = GuildSync(GUILD_ID, channel_plan("rules", "general"), [everyone()], channels)
+    assert [(op.action, op.kind) for op in sync.operations] == [("move", "channel")]
+    assert sync.operations[0].changes == {"channels": [
+        {"id": "11", "name": "rules", "position": 0, "parent": "Text"},
+        {"id": "12", "name": "general", "position": 1, "parent": "Text"},
+    ]}
+
+
+def test_channel_outside_its_category_is_moved_into_it():
+    channels = [channel(10, "Text", 4, 0), channel(11, "rules", 0, 0)]
+    sync = GuildSync(GUILD_ID, channel_plan("rules"), [everyone()], channels)
+    assert [(op.action, op.kind) for op in sync.operations] == [("move", "channel")]
+    assert sync.operations[0].changes["channels"] == [{"id": "11", "name": "rules", "position": 0, "parent": "Text"}]
+
+
+def test_changed_overwrites_are_edited_and_channels_follow_the_category():
+    hidden = {"@everyone": {"allow": 0, "deny": 1024}}
+    channels = [channel(10, "Text", 4, 0), channel(11, "rules", 0, 0, 10)]
+    sync = GuildSync(GUILD_ID, channel_plan("rules", permissions=hidden), [everyone()], channels)
+    assert [(op.action, op.kind, op.name, op.changes) for op in sync.operations] == [
+        ("edit", "category", "Text", {"overwrites": hidden}),
+        ("edit", "channel", "rules", {"overwrites": hidden}),
+    ]
+
+
+def test_missing_channels_are_created_and_extra_ones_deleted_children_first():
+    channels = [channel(20, "Old", 4, 1), channel(21, "stale", 0, 0, 20), channel(10, "Text", 4, 0)]
+    sync = GuildSync(GUILD_ID, channel_plan("rules"), [everyone()], channels)
+    assert [(op.action, op.kind, op.name) for op in sync.operations] == [
+        ("create", "channel", "rules"),
+        ("delete", "channel", "stale"),
+        ("delete", "category", "Old"),
+    ]
+    assert sync.operations[0].changes == {"type": "text", "position": 0, "parent": "Text", "overwrites": {}}